@@ -0,0 +1,231 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+
+from endpoint_router import EndpointRouter, EndpointTarget, router
+
+MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 32))
+POLL_INTERVAL = 1.0
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing a request when the wait queue is full."""
+
+
+@dataclass
+class QueueStatus:
+    position: int
+    waiting: int
+    eta: float | None
+
+    def message(self) -> str:
+        eta = f", about {self.eta:.0f} s" if self.eta is not None else ""
+        return (
+            f"⏳ Waiting for the model: position {self.position} "
+            f"of {self.waiting}{eta}"
+        )
+
+
+class Ticket:
+    """A request's place in the admission queue, and its slot once admitted."""
+
+    def __init__(self, pool: str, session: str):
+        self.pool = pool
+        self.session = session
+        self.target: EndpointTarget | None = None
+        self.granted = threading.Event()
+        self.admitted_at = None
+        self.released = False
+        self._waker = None
+
+
+class AdmissionController:
+    """
+    Queues chat requests in front of the endpoints so a burst waits its turn instead of
+    being throttled.
+
+    Each target streams at most `max_concurrency` responses at once. Requests beyond
+    that wait in a queue per model, served round-robin across sessions so one user
+    sending several messages cannot starve the others, and are shed with `Overloaded`
+    once `max_queue` requests are waiting. The estimated wait comes from a moving
+    average of how long admitted requests hold their slot.
+    """
+
+    def __init__(
+        self,
+        router: EndpointRouter,
+        max_queue: int = MAX_QUEUE,
+        ewma_alpha: float = 0.2,
+    ):
+        self.router = router
+        self.max_queue = max_queue
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._active = {}
+        self._queues = {}
+        self._service_time = {}
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.moved = 0
+
+    def _pool(self, model: str | None) -> str:
+        first = self.router.candidates(model)[0]
+        return first.model or first.endpoint_name
+
+    def _free_target(self, pool: str) -> EndpointTarget | None:
+        for target in self.router.candidates(pool):
+            if self._active.get(target.name, 0) < target.max_concurrency:
+                return target
+        return None
+
+    def _waiting(self) -> int:
+        return sum(
+            len(tickets)
+            for queue in self._queues.values()
+            for tickets in queue.values()
+        )
+
+    def _grant(self, ticket: Ticket, target: EndpointTarget):
+        self._active[target.name] = self._active.get(target.name, 0) + 1
+        ticket.target = target
+        ticket.admitted_at = time.monotonic()
+        self.admitted += 1
+        ticket.granted.set()
+        if ticket._waker is not None:
+            loop, future = ticket._waker
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+    def _dispatch(self, pool: str):
+        queue = self._queues.get(pool)
+        while queue:
+            target = self._free_target(pool)
+            if target is None:
+                return
+            session, tickets = next(iter(queue.items()))
+            ticket = tickets.popleft()
+            if tickets:
+                queue.move_to_end(session)
+            else:
+                del queue[session]
+            self._grant(ticket, target)
+
+    def enqueue(self, model: str | None, session: str | None = None) -> Ticket:
+        """Admit a request straight away if a target has room, else queue it."""
+        session = session or "anonymous"
+        with self._lock:
+            pool = self._pool(model)
+            ticket = Ticket(pool, session)
+            queue = self._queues.setdefault(pool, OrderedDict())
+            if not queue:
+                target = self._free_target(pool)
+                if target is not None:
+                    self._grant(ticket, target)
+                    return ticket
+            if self._waiting() >= self.max_queue:
+                self.shed += 1
+                raise Overloaded(
+                    "The model is busy right now, please try again in a minute."
+                )
+            self.queued += 1
+            queue.setdefault(session, deque()).append(ticket)
+            return ticket
+
+    def move(self, ticket: Ticket, target: EndpointTarget):
+        """
+        Charge an admitted ticket's slot to `target`, the target its stream was
+        actually opened on after failing over or hedging away from the one it was
+        admitted to. `target` may go over its limit until the ticket is released;
+        no more requests are admitted to it meanwhile.
+        """
+        with self._lock:
+            if ticket.released or ticket.target in (None, target):
+                return
+            self._active[ticket.target.name] -= 1
+            self._active[target.name] = self._active.get(target.name, 0) + 1
+            ticket.target = target
+            self.moved += 1
+            self._dispatch(ticket.pool)
+
+    def release(self, ticket: Ticket):
+        """Give back the ticket's slot, or leave the queue if it was never admitted."""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.target is not None:
+                name = ticket.target.name
+                self._active[name] -= 1
+                held = time.monotonic() - ticket.admitted_at
+                previous = self._service_time.get(ticket.pool)
+                self._service_time[ticket.pool] = (
+                    held
+                    if previous is None
+                    else previous + self.ewma_alpha * (held - previous)
+                )
+            else:
+                tickets = self._queues[ticket.pool].get(ticket.session)
+                if tickets is not None:
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self._queues[ticket.pool][ticket.session]
+            self._dispatch(ticket.pool)
+
+    def status(self, ticket: Ticket) -> QueueStatus:
+        with self._lock:
+            queue = self._queues.get(ticket.pool, {})
+            # The order tickets will be admitted in: one per session per round.
+            order = [
+                t
+                for turn in itertools.zip_longest(*queue.values())
+                for t in turn
+                if t is not None
+            ]
+            position = order.index(ticket) if ticket in order else 0
+            capacity = sum(
+                t.max_concurrency for t in self.router.candidates(ticket.pool)
+            )
+            service_time = self._service_time.get(ticket.pool)
+        eta = None
+        if service_time is not None and capacity:
+            eta = (position + 1) * service_time / capacity
+        return QueueStatus(position + 1, len(order), eta)
+
+    def wait(self, ticket: Ticket, poll: float = POLL_INTERVAL):
+        """Yield the ticket's `QueueStatus` every `poll` seconds until it is admitted."""
+        while not ticket.granted.is_set():
+            yield self.status(ticket)
+            ticket.granted.wait(poll)
+
+    async def await_admission(self, ticket: Ticket, poll: float = POLL_INTERVAL):
+        loop = asyncio.get_running_loop()
+        while not ticket.granted.is_set():
+            yield self.status(ticket)
+            future = loop.create_future()
+            with self._lock:
+                ticket._waker = (loop, future)
+            if not ticket.granted.is_set():
+                await asyncio.wait({future}, timeout=poll)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_queue": self.max_queue,
+                "active": dict(self._active),
+                "waiting": {
+                    pool: sum(len(tickets) for tickets in queue.values())
+                    for pool, queue in self._queues.items()
+                },
+                "service_time_s": dict(self._service_time),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "shed": self.shed,
+                "moved": self.moved,
+            }
+
+
+admission = AdmissionController(router)
@@ -0,0 +1,268 @@
+"""
+Headless batch runner for JSONL request files.
+
+Each input line is either a chat history (the same JSON list the "JSON History" mode
+of `r1_demo_blocks.py` accepts) or an object with `messages` and optional `params` and
+`id`. Results are written to an output JSONL as one object per input line. The output
+file doubles as the checkpoint: rerunning with `--resume` skips lines that already
+succeeded.
+
+With `tools` in the params, as specs or names of tools registered in `tools.py`, the
+model's tool calls are run and their timings are written as `tool_steps`.
+
+Usage:
+    python batch_runner.py requests.jsonl results.jsonl --concurrency 8 --rate 2
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from logprobs import LogprobCapture
+from sagemaker_utils import invoke_endpoint, invoke_with_tools
+from stream_parser import JsonStreamParser, ThinkStreamParser
+from tools import ToolStep, tool_registry
+
+
+class RateLimiter:
+    """Spaces request starts at least `1 / rate` seconds apart across all workers."""
+
+    def __init__(self, rate: float | None):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(max(0, start - now))
+
+
+def parse_request(
+    line: str, system_prompt: str | None = None
+) -> tuple[str | None, list, dict]:
+    data = json.loads(line)
+    if isinstance(data, list):
+        request_id, messages, params = None, data, {}
+    else:
+        request_id = data.get("id")
+        messages = data["messages"]
+        params = data.get("params", {})
+    if system_prompt and (not messages or messages[0]["role"] != "system"):
+        messages = [{"role": "system", "content": system_prompt}] + messages
+    return request_id, messages, params
+
+
+def read_requests(path: Path, skip: set[int]):
+    """Yield (line number, raw line) lazily so the input is never loaded whole."""
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if line.strip() and line_no not in skip:
+                yield line_no, line
+
+
+def load_checkpoint(output: Path) -> set[int]:
+    """
+    Collect the input lines already present in `output`.
+
+    A crash can leave a partially written last line, so the file is rewritten with only
+    the complete, successful records before new results are appended to it. Failed
+    requests are dropped and run again.
+    """
+    if not output.exists():
+        return set()
+    done = set()
+    records = []
+    with open(output, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "error" in record:
+                continue
+            done.add(record["line"])
+            records.append(line if line.endswith("\n") else line + "\n")
+    tmp = output.with_suffix(output.suffix + ".tmp")
+    tmp.write_text("".join(records), encoding="utf-8")
+    tmp.replace(output)
+    return done
+
+
+def run_request(
+    line_no: int,
+    line: str,
+    params: dict,
+    system_prompt: str | None,
+    rate_limiter: RateLimiter,
+) -> dict:
+    result = {"line": line_no, "id": None}
+    try:
+        request_id, messages, request_params = parse_request(line, system_prompt)
+        result["id"] = request_id
+        rate_limiter.wait()
+        request_params = {**params, **request_params}
+        parser = ThinkStreamParser()
+        if request_params.get("response_format"):
+            # Records survive in the result even if the answer is cut off or fails.
+            json_parser = JsonStreamParser()
+            result["records"] = records = []
+        logprobs = (
+            LogprobCapture(top_k=request_params.get("top_logprobs") or 0)
+            if request_params.get("logprobs")
+            else None
+        )
+        invoke = invoke_endpoint
+        if request_params.get("tools"):
+            # Registered tools can be given by name instead of as full specs.
+            tools = request_params["tools"]
+            request_params["tools"] = [t for t in tools if not isinstance(t, str)]
+            request_params["tools"] += tool_registry.specs(
+                [t for t in tools if isinstance(t, str)]
+            )
+            invoke = invoke_with_tools
+            result["tool_steps"] = []
+        start = time.perf_counter()
+        first_token = None
+        for chunk in invoke(messages, logprob_capture=logprobs, **request_params):
+            if isinstance(chunk, ToolStep):
+                # Only the answer after the last tool step is kept.
+                if chunk.done:
+                    result["tool_steps"].append(chunk.summary())
+                    parser = ThinkStreamParser()
+                continue
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            events = parser.feed(chunk)
+            if "records" in result:
+                records.extend(json_parser.feed_events(events))
+        events = parser.close()
+        if "records" in result:
+            records.extend(json_parser.feed_events(events))
+            result["complete_json"] = json_parser.complete
+        result.update(
+            thinking=parser.thinking,
+            answer=parser.answer,
+            timings={
+                "time_to_first_token": first_token,
+                "total": time.perf_counter() - start,
+            },
+        )
+        if logprobs is not None:
+            result["logprobs"] = logprobs.choice(0).summary()
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def run_batch(
+    input_path: Path,
+    output_path: Path,
+    params: dict | None = None,
+    system_prompt: str | None = None,
+    concurrency: int = 4,
+    rate: float | None = None,
+    ordered: bool = True,
+    resume: bool = False,
+):
+    done = load_checkpoint(output_path) if resume else set()
+    rate_limiter = RateLimiter(rate)
+    # Bounds both in-flight requests and results buffered while waiting for order.
+    window = concurrency * 2
+    submitted = deque()
+    finished = {}
+    counts = {"ok": 0, "error": 0}
+
+    with (
+        open(output_path, "a" if resume else "w", encoding="utf-8") as out,
+        ThreadPoolExecutor(concurrency) as pool,
+    ):
+
+        def write(result: dict):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            counts["error" if "error" in result else "ok"] += 1
+
+        def collect(futures, return_when):
+            completed, _ = wait(futures, return_when=return_when)
+            for future in completed:
+                result = future.result()
+                del futures[future]
+                if ordered:
+                    finished[result["line"]] = result
+                else:
+                    write(result)
+            while ordered and submitted and submitted[0] in finished:
+                write(finished.pop(submitted.popleft()))
+
+        futures = {}
+        for line_no, line in read_requests(input_path, done):
+            while len(futures) + len(finished) >= window:
+                collect(futures, FIRST_COMPLETED)
+            futures[
+                pool.submit(
+                    run_request,
+                    line_no,
+                    line,
+                    params or {},
+                    system_prompt,
+                    rate_limiter,
+                )
+            ] = line_no
+            submitted.append(line_no)
+        while futures:
+            collect(futures, FIRST_COMPLETED)
+
+    print(
+        f"Batch finished: {counts['ok']} ok, {counts['error']} failed, "
+        f"{len(done)} skipped from checkpoint"
+    )
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", type=Path, help="JSONL file of requests")
+    parser.add_argument("output", type=Path, help="JSONL file to write results to")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, help="Max requests started per second")
+    parser.add_argument(
+        "--as-completed",
+        action="store_true",
+        help="Write results as they finish instead of in input order",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="Skip lines already in the output file"
+    )
+    parser.add_argument(
+        "--params", default="{}", help="JSON object of generation parameters"
+    )
+    parser.add_argument(
+        "--system-prompt",
+        type=Path,
+        help="System prompt file for requests without a system message",
+    )
+    args = parser.parse_args()
+
+    run_batch(
+        args.input,
+        args.output,
+        params=json.loads(args.params),
+        system_prompt=args.system_prompt.read_text() if args.system_prompt else None,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        ordered=not args.as_completed,
+        resume=args.resume,
+    )
+
+
+if __name__ == "__main__":
+    main()
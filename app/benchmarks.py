@@ -0,0 +1,241 @@
+"""
+Offline micro-benchmarks for the per-token streaming path.
+
+Synthetic SageMaker event streams are fed through `LineIterator`, the decode loop of
+`invoke_endpoint` (with a stubbed runtime client, no network), logprob capture into
+`TokenLogprobs` columns (run it with `--logprobs`), the think-tag parser
+used by the chat handlers and the incremental JSON parser for structured answers.
+Reports microseconds per token, peak traced allocations and, on Linux, how far RSS
+rose above its starting level during each stage, sampled from /proc/self/statm.
+
+Usage:
+    python benchmarks.py --tokens 100 1000 50000 --logprobs
+"""
+
+import argparse
+import functools
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from logprobs import LogprobCapture
+from sagemaker_utils import (
+    DEFAULT_ENDPOINT_NAME,
+    DEFAULT_REGION,
+    LineIterator,
+    client_manager,
+    decode_line,
+    invoke_endpoint,
+)
+from stream_parser import FlushPolicy, JsonStreamParser, ThinkStreamParser
+
+WORDS = ["the", " form", " field", " maps", " to", " Patient", " DOB", ",", "\n", " é"]
+
+
+def synthetic_tokens(n_tokens: int, rng: random.Random, split_tags: bool) -> list[str]:
+    """A `<think>` block followed by an answer, with the tags optionally split in two."""
+    think_at = n_tokens // 10
+    end_at = n_tokens * 3 // 4
+    tokens = [rng.choice(WORDS) for _ in range(n_tokens)]
+    for at, tag in ((think_at, "<think>"), (end_at, "</think>")):
+        if split_tags:
+            cut = rng.randint(1, len(tag) - 1)
+            tokens[at : at + 2] = [tag[:cut], tag[cut:]]
+        else:
+            tokens[at] = tag
+    return tokens
+
+
+def encode_stream(tokens: list[str], logprobs: bool) -> bytes:
+    lines = []
+    for token in tokens:
+        choice = {"index": 0, "delta": {"role": "assistant", "content": token}}
+        if logprobs:
+            choice["logprobs"] = {
+                "content": [
+                    {
+                        "token": token,
+                        "logprob": -0.25,
+                        "top_logprobs": [
+                            {"token": w, "logprob": -1.5} for w in WORDS[:5]
+                        ],
+                    }
+                ]
+            }
+        chunk = {"object": "chat.completion.chunk", "choices": [choice]}
+        lines.append(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+    return b"".join(lines)
+
+
+def payload_parts(data: bytes, rng: random.Random, max_split: int) -> list[dict]:
+    """Cut the stream into PayloadParts at random byte offsets."""
+    parts = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, max_split)
+        parts.append({"PayloadPart": {"Bytes": data[pos : pos + size]}})
+        pos += size
+    return parts
+
+
+class StubRuntimeClient:
+    """Stands in for the `sagemaker-runtime` client and replays prepared events."""
+
+    def __init__(self, events: list[dict]):
+        self.events = events
+
+    def invoke_endpoint_with_response_stream(self, **request):
+        return {"Body": iter(self.events)}
+
+
+def bench_line_iterator(events, tokens):
+    for line in LineIterator(events):
+        pass
+
+
+def bench_decode(events, tokens):
+    for line in LineIterator(events):
+        decode_line(line)
+
+
+def bench_logprob_capture(events, tokens):
+    capture = LogprobCapture(top_k=5)
+    for line in LineIterator(events):
+        decode_line(line, capture)
+    capture.summary()
+
+
+def bench_invoke_endpoint(events, tokens):
+    client_manager._clients[(DEFAULT_REGION, DEFAULT_ENDPOINT_NAME)] = (
+        StubRuntimeClient(events)
+    )
+    for _ in invoke_endpoint([{"role": "user", "content": "benchmark"}]):
+        pass
+
+
+def bench_think_parser(events, tokens):
+    parser = ThinkStreamParser()
+    flush_policy = FlushPolicy()
+    for token in tokens:
+        if flush_policy.should_flush(parser.feed(token)):
+            # Reading the text joins the builders' parts, as rendering an update does.
+            _ = parser.thinking, parser.answer
+    parser.close()
+
+
+@functools.lru_cache(maxsize=None)
+def json_answer_tokens(n_tokens: int) -> list[str]:
+    """A structured form-mapping answer cut into about `n_tokens` 4-character tokens."""
+    mappings = [
+        {"index": i, "label": "User Input Text Field"} for i in range(n_tokens // 12)
+    ]
+    text = json.dumps({"mappings": mappings})
+    return [text[i : i + 4] for i in range(0, len(text), 4)]
+
+
+def bench_json_stream(events, tokens):
+    parser = JsonStreamParser()
+    for token in json_answer_tokens(len(tokens)):
+        parser.feed(token)
+
+
+BENCHMARKS = {
+    "line_iterator": bench_line_iterator,
+    "decode": bench_decode,
+    "logprob_capture": bench_logprob_capture,
+    "invoke_endpoint": bench_invoke_endpoint,
+    "think_parser": bench_think_parser,
+    "json_stream": bench_json_stream,
+}
+
+
+def rss_kb() -> int | None:
+    """Current resident set size; `ru_maxrss` is a lifetime peak and would not reset."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def rss_rise_kb(bench, events, tokens, interval: float = 0.001) -> int | None:
+    """How far RSS rises above its level before `bench`, sampled while it runs."""
+    before = rss_kb()
+    if before is None:
+        return None
+    peak = before
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.wait(interval):
+            peak = max(peak, rss_kb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    bench(events, tokens)
+    done.set()
+    sampler.join()
+    return max(peak, rss_kb()) - before
+
+
+def run(bench, events, tokens, repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        bench(events, tokens)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    bench(events, tokens)
+    _, peak_alloc = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "us_per_token": best / len(tokens) * 1e6,
+        "peak_alloc_kb": peak_alloc / 1024,
+        "rss_rise_kb": rss_rise_kb(bench, events, tokens),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tokens", type=int, nargs="+", default=[100, 4000, 50000])
+    parser.add_argument("--logprobs", action="store_true")
+    parser.add_argument(
+        "--max-split", type=int, default=64, help="Max bytes per PayloadPart"
+    )
+    parser.add_argument(
+        "--no-split-tags",
+        action="store_true",
+        help="Keep <think> tags within a single chunk",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--only", choices=BENCHMARKS, nargs="+", default=list(BENCHMARKS)
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'benchmark':<16} {'tokens':>7} {'us/token':>9} {'alloc KB':>9} {'rss KB':>7}"
+    )
+    for n_tokens in args.tokens:
+        rng = random.Random(args.seed)
+        tokens = synthetic_tokens(n_tokens, rng, split_tags=not args.no_split_tags)
+        events = payload_parts(
+            encode_stream(tokens, args.logprobs), rng, args.max_split
+        )
+        for name in args.only:
+            result = run(BENCHMARKS[name], events, tokens, args.repeat)
+            rss = result["rss_rise_kb"]
+            print(
+                f"{name:<16} {n_tokens:>7} {result['us_per_token']:>9.2f} "
+                f"{result['peak_alloc_kb']:>9.1f} {'-' if rss is None else rss:>7}"
+            )
+
+
+if __name__ == "__main__":
+    main()
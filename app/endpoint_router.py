@@ -0,0 +1,241 @@
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+
+from botocore.exceptions import (
+    ClientError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+DEFAULT_REGION = "us-west-2"
+DEFAULT_ENDPOINT_NAME = "xifin-reasoner-7b-endpoint"
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("ENDPOINT_MAX_CONCURRENCY", 8))
+
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailable",
+    "InternalFailure",
+    "InternalStreamFailure",
+    "ModelNotReadyException",
+}
+CONNECTION_ERRORS = (
+    EndpointConnectionError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    ReadTimeoutError,
+)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Throttling, 5xx and connection errors are worth sending to another target."""
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in RETRYABLE_ERROR_CODES or status == 429 or status >= 500
+    return False
+
+
+@dataclass
+class EndpointTarget:
+    endpoint_name: str
+    region: str = DEFAULT_REGION
+    variant: str | None = None
+    model: str | None = None
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    in_flight: int = 0
+    requests: int = 0
+    failures: int = 0
+    latency_ewma: float | None = None
+    unhealthy_until: float = 0.0
+
+    @property
+    def name(self) -> str:
+        variant = f":{self.variant}" if self.variant else ""
+        return f"{self.region}/{self.endpoint_name}{variant}"
+
+    def serves(self, model: str) -> bool:
+        return model in (self.model, self.endpoint_name)
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.unhealthy_until
+
+    def request(self, body: str) -> dict:
+        request = dict(
+            EndpointName=self.endpoint_name,
+            ContentType="application/json",
+            Body=body,
+            CustomAttributes="accept_eula=true",
+        )
+        if self.variant:
+            request["TargetVariant"] = self.variant
+        return request
+
+
+class EndpointRouter:
+    """
+    Spreads requests over the SageMaker endpoints and variants that serve a model.
+
+    Targets are ordered by health, then in-flight requests, then the moving average of
+    their time to first byte, and the caller works down the list on retryable errors.
+    A target that throttles or returns a 5xx is sent to the back of the list for
+    `cooldown` seconds.
+    """
+
+    def __init__(
+        self,
+        targets: list[EndpointTarget],
+        cooldown: float = 30,
+        ewma_alpha: float = 0.3,
+    ):
+        self.targets = targets
+        self.cooldown = cooldown
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path: str | None) -> "EndpointRouter":
+        """
+        Load targets from a JSON list of `{"endpoint_name", "region", "variant",
+        "model", "max_concurrency"}` objects, or route everything to the default endpoint.
+        """
+        if path:
+            with open(path, encoding="utf-8") as f:
+                return cls([EndpointTarget(**target) for target in json.load(f)])
+        return cls(
+            [
+                EndpointTarget(DEFAULT_ENDPOINT_NAME),
+                EndpointTarget("xifin-chat-llama3-1-8b-instruct-endpoint"),
+            ]
+        )
+
+    def candidates(
+        self, model: str | None = None, prefer: EndpointTarget | None = None
+    ) -> list[EndpointTarget]:
+        """
+        Targets for `model`, best first; unknown models go to the first target's. A
+        healthy `prefer` target, such as the one a request was admitted to, goes first.
+        """
+        targets = [t for t in self.targets if model and t.serves(model)]
+        if not targets:
+            first = self.targets[0]
+            targets = [
+                t for t in self.targets if t.serves(first.model or first.endpoint_name)
+            ]
+        now = time.monotonic()
+        with self._lock:
+            return sorted(
+                targets,
+                key=lambda t: (
+                    not (t is prefer and t.healthy(now)),
+                    not t.healthy(now),
+                    t.in_flight,
+                    t.latency_ewma or 0,
+                ),
+            )
+
+    def start(self, target: EndpointTarget):
+        with self._lock:
+            target.in_flight += 1
+            target.requests += 1
+
+    def observe_latency(self, target: EndpointTarget, seconds: float):
+        with self._lock:
+            if target.latency_ewma is None:
+                target.latency_ewma = seconds
+            else:
+                target.latency_ewma += self.ewma_alpha * (seconds - target.latency_ewma)
+
+    def finish(self, target: EndpointTarget, error: Exception | None = None):
+        with self._lock:
+            target.in_flight -= 1
+            if error is not None:
+                target.failures += 1
+                if is_retryable(error):
+                    target.unhealthy_until = time.monotonic() + self.cooldown
+
+    def models(self) -> list[str]:
+        return list(dict.fromkeys(t.model or t.endpoint_name for t in self.targets))
+
+    def client_keys(self) -> list[tuple[str, str]]:
+        return [(t.region, t.endpoint_name) for t in self.targets]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                t.name: {
+                    "model": t.model or t.endpoint_name,
+                    "max_concurrency": t.max_concurrency,
+                    "healthy": t.healthy(now),
+                    "in_flight": t.in_flight,
+                    "requests": t.requests,
+                    "failures": t.failures,
+                    "latency_ewma_s": t.latency_ewma,
+                }
+                for t in self.targets
+            }
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Retries and opt-in hedging for the part of a request before its first token.
+
+    Retryable errors are retried `max_retries` times with full-jitter exponential
+    backoff on top of failing over once through the targets. The runtime clients have
+    botocore's own retries turned off, so the default of 4 keeps the 5 attempts of
+    botocore's legacy retry mode they used to make. With `hedge_delay` set, a
+    duplicate request goes to the next target when the first has not produced a byte
+    after that many seconds; whichever stream produces data first is used and the
+    other is closed.
+    """
+
+    max_retries: int = 4
+    base_backoff: float = 0.25
+    max_backoff: float = 4.0
+    hedge_delay: float | None = None
+    retries: int = 0
+    hedges_fired: int = 0
+    hedges_won: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2**retry))
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_hedge(self, won: bool):
+        with self._lock:
+            self.hedges_fired += 1
+            self.hedges_won += won
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_retries": self.max_retries,
+                "hedge_delay_s": self.hedge_delay,
+                "retries": self.retries,
+                "hedges_fired": self.hedges_fired,
+                "hedges_won": self.hedges_won,
+            }
+
+
+router = EndpointRouter.from_config(os.environ.get("SAGEMAKER_ENDPOINTS_CONFIG"))
+retry_policy = RetryPolicy(
+    max_retries=int(os.environ.get("RETRY_MAX", 4)),
+    hedge_delay=(
+        float(os.environ["HEDGE_DELAY_MS"]) / 1000
+        if os.environ.get("HEDGE_DELAY_MS")
+        else None
+    ),
+)
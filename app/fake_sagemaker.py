@@ -0,0 +1,358 @@
+"""
+Local stand-in for the SageMaker runtime's response-streaming API.
+
+Serves `InvokeEndpointWithResponseStream` over HTTP in the AWS event-stream encoding,
+so the unmodified boto3 and aiobotocore clients can be pointed at it with
+`SAGEMAKER_ENDPOINT_URL=http://127.0.0.1:8090` (any AWS credentials will do, it does
+not check signatures). Each request streams either a synthetic `<think>` block and
+answer or one of the `--replay` recordings, with a configurable time to first token,
+token rate and `PayloadPart` fragmentation, and can be made to fail with throttling,
+5xx responses or a `ModelStreamError` part-way through the stream.
+
+A recording is the raw body the endpoint streamed (the `PayloadPart` bytes joined
+together); `record` saves one from a real endpoint.
+
+Usage:
+    python fake_sagemaker.py serve --port 8090 --ttft 0.8 --tokens-per-second 40
+    python fake_sagemaker.py record request.json recordings/long_answer.sse
+"""
+
+import argparse
+import binascii
+import json
+import random
+import re
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from endpoint_router import DEFAULT_ENDPOINT_NAME, DEFAULT_REGION, EndpointTarget
+
+WORDS = [" the", " form", " field", " maps", " to", " Patient", " DOB", ",", ".", "\n"]
+PATH = re.compile(r"^/endpoints/([^/]+)/invocations-response-stream$")
+
+
+def encode_event(headers: dict[str, str], payload: bytes) -> bytes:
+    """One event-stream message: prelude, string headers, payload and CRCs."""
+    encoded_headers = b""
+    for name, value in headers.items():
+        name, value = name.encode("utf-8"), value.encode("utf-8")
+        encoded_headers += (
+            struct.pack("!B", len(name)) + name + struct.pack("!BH", 7, len(value))
+        ) + value
+    total = 12 + len(encoded_headers) + len(payload) + 4
+    prelude = struct.pack("!II", total, len(encoded_headers))
+    prelude += struct.pack("!I", binascii.crc32(prelude))
+    message = prelude + encoded_headers + payload
+    return message + struct.pack("!I", binascii.crc32(message))
+
+
+def payload_part(data: bytes) -> bytes:
+    return encode_event(
+        {
+            ":event-type": "PayloadPart",
+            ":content-type": "application/octet-stream",
+            ":message-type": "event",
+        },
+        data,
+    )
+
+
+def model_stream_error(message: str) -> bytes:
+    return encode_event(
+        {
+            ":exception-type": "ModelStreamError",
+            ":content-type": "application/json",
+            ":message-type": "exception",
+        },
+        json.dumps({"Message": message, "ErrorCode": "ModelStreamError"}).encode(),
+    )
+
+
+def chunk_line(index: int, content: str, finish_reason: str | None = None) -> bytes:
+    chunk = {
+        "object": "chat.completion.chunk",
+        "choices": [
+            {
+                "index": index,
+                "delta": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }
+        ],
+    }
+    return b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n"
+
+
+def synthetic_tokens(n_tokens: int, rng: random.Random) -> list[str]:
+    """A `<think>` block over the first three quarters of the tokens, then an answer."""
+    tokens = ["<think>"] + [rng.choice(WORDS) for _ in range(max(n_tokens - 2, 0))]
+    tokens.insert(max(n_tokens * 3 // 4, 1), "</think>")
+    return tokens[:n_tokens]
+
+
+@dataclass
+class FakeConfig:
+    ttft: float = 0.5
+    tokens_per_second: float = 50.0
+    tokens: int = 400
+    max_part_bytes: int = 64
+    throttle_rate: float = 0.0
+    server_error_rate: float = 0.0
+    stream_error_rate: float = 0.0
+    recordings: list[bytes] = field(default_factory=list)
+    seed: int | None = None
+
+
+class FakeSageMaker(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], config: FakeConfig):
+        super().__init__(address, _FakeHandler)
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.injected = {"throttle": 0, "server_error": 0, "stream_error": 0}
+
+    def draw(self) -> tuple[random.Random, str | None]:
+        """A random generator for one request, and the failure to inject, if any."""
+        config = self.config
+        with self._lock:
+            self.requests += 1
+            rng = random.Random(self.rng.random())
+            roll = rng.random()
+            failure = None
+            for name, rate in (
+                ("throttle", config.throttle_rate),
+                ("server_error", config.server_error_rate),
+                ("stream_error", config.stream_error_rate),
+            ):
+                if roll < rate:
+                    failure = name
+                    self.injected[name] += 1
+                    break
+                roll -= rate
+            return rng, failure
+
+    def lines(self, body: dict, rng: random.Random) -> list[bytes]:
+        """The response lines for one request, each paced as one token."""
+        config = self.config
+        if config.recordings:
+            recording = rng.choice(config.recordings)
+            return [line + b"\n\n" for line in recording.split(b"\n\n") if line.strip()]
+        n_tokens = min(config.tokens, int(body.get("max_tokens") or config.tokens))
+        n = int(body.get("n") or 1)
+        finish_reason = "length" if n_tokens < config.tokens else "stop"
+        choices = [synthetic_tokens(n_tokens, rng) for _ in range(n)]
+        lines = []
+        for position in range(n_tokens):
+            last = position == n_tokens - 1
+            for index, tokens in enumerate(choices):
+                lines.append(
+                    chunk_line(index, tokens[position], finish_reason if last else None)
+                )
+        return lines
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "injected": dict(self.injected)}
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: FakeSageMaker
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not PATH.match(self.path):
+            self.send_json(404, "UnknownOperationException", f"No route {self.path}")
+            return
+        config = self.server.config
+        rng, failure = self.server.draw()
+        if failure == "throttle":
+            self.send_json(400, "ThrottlingException", "Rate exceeded")
+            return
+        if failure == "server_error":
+            self.send_json(503, "ServiceUnavailable", "Injected 5xx")
+            return
+        lines = self.server.lines(json.loads(body or b"{}"), rng)
+        # The stream fails somewhere after its first token, like a model crash would.
+        fail_at = rng.randint(1, max(len(lines) - 1, 1)) if failure else None
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+        self.send_header("x-Amzn-Invoked-Production-Variant", "AllTraffic")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        start = time.perf_counter() + config.ttft
+        try:
+            for position, line in enumerate(lines):
+                if position == fail_at:
+                    self.write_chunk(model_stream_error("Injected stream error"))
+                    break
+                delay = (
+                    start + position / config.tokens_per_second - time.perf_counter()
+                )
+                if delay > 0:
+                    time.sleep(delay)
+                for part in self.fragment(line, rng):
+                    self.write_chunk(payload_part(part))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream, e.g. the user pressed Stop.
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path == "/stats":
+            body = json.dumps(self.server.stats()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def fragment(self, line: bytes, rng: random.Random) -> list[bytes]:
+        """Cut a line at random byte offsets, as the real stream may do."""
+        max_part = self.server.config.max_part_bytes
+        if max_part <= 0:
+            return [line]
+        parts = []
+        pos = 0
+        while pos < len(line):
+            size = rng.randint(1, max_part)
+            parts.append(line[pos : pos + size])
+            pos += size
+        return parts
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, status: int, code: str, message: str):
+        body = json.dumps({"message": message}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-amz-json-1.1")
+        self.send_header("x-amzn-ErrorType", code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str, port: int, config: FakeConfig) -> FakeSageMaker:
+    """Start the stand-in on a daemon thread and return the server."""
+    server = FakeSageMaker((host, port), config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def record(request_path: Path, output_path: Path, target: EndpointTarget):
+    """Save the raw response stream of one request to a real endpoint."""
+    from sagemaker_utils import build_payload, client_manager
+
+    request = json.loads(request_path.read_text(encoding="utf-8"))
+    messages = request.pop("messages")
+    body = json.dumps(build_payload(messages, **request))
+    response = client_manager.get_client(
+        target.region, target.endpoint_name
+    ).invoke_endpoint_with_response_stream(**target.request(body))
+    with output_path.open("wb") as f:
+        for event in response["Body"]:
+            if "PayloadPart" in event:
+                f.write(event["PayloadPart"]["Bytes"])
+    print(f"Recorded {output_path.stat().st_size} bytes to {output_path}")
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser):
+    """The stand-in's options, shared with `load_test.py`."""
+    parser.add_argument(
+        "--ttft", type=float, default=0.5, help="Seconds to the first token"
+    )
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=400,
+        help="Synthetic answer length, capped by the request's max_tokens",
+    )
+    parser.add_argument(
+        "--max-part-bytes",
+        type=int,
+        default=64,
+        help="Cut lines into PayloadParts of at most this many bytes; 0 keeps lines whole",
+    )
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--stream-error-rate",
+        type=float,
+        default=0.0,
+        help="Share of streams that fail with a ModelStreamError after the first token",
+    )
+    parser.add_argument(
+        "--replay",
+        type=Path,
+        nargs="+",
+        default=[],
+        help="Recorded streams to replay instead of synthetic ones",
+    )
+    parser.add_argument("--seed", type=int)
+
+
+def fake_config(args: argparse.Namespace) -> FakeConfig:
+    return FakeConfig(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        tokens=args.tokens,
+        max_part_bytes=args.max_part_bytes,
+        throttle_rate=args.throttle_rate,
+        server_error_rate=args.server_error_rate,
+        stream_error_rate=args.stream_error_rate,
+        recordings=[path.read_bytes() for path in args.replay],
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="Run the stand-in endpoint")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8090)
+    add_fake_arguments(serve_parser)
+
+    record_parser = commands.add_parser(
+        "record", help="Save a real endpoint's response stream for --replay"
+    )
+    record_parser.add_argument(
+        "request", type=Path, help="JSON object with messages and generation parameters"
+    )
+    record_parser.add_argument("output", type=Path)
+    record_parser.add_argument("--endpoint-name", default=DEFAULT_ENDPOINT_NAME)
+    record_parser.add_argument("--region", default=DEFAULT_REGION)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(
+            args.request, args.output, EndpointTarget(args.endpoint_name, args.region)
+        )
+        return
+
+    server = FakeSageMaker((args.host, args.port), fake_config(args))
+    print(f"Fake SageMaker runtime on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
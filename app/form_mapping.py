@@ -0,0 +1,313 @@
+"""
+Sharded form-mapping pipeline for large PDF field tables.
+
+The field table is split into index-contiguous shards that are mapped concurrently with
+the `share/prompt.txt` system prompt, and the per-field labels are merged into one
+result. Each shard's answer is checked for a valid label on every field it was given.
+Fields that failed, were left out or got a label that is not in the prompt's list are
+run again as new shards. Answers are parsed as they stream, so the mappings an answer
+completed before it was cut off at `max_tokens` are kept, and its remaining fields are
+split in half for the next round so they fit.
+
+With `"logprobs": true` in `--params`, each mapping also gets the lowest token
+probability of its record as `confidence`, and the fields below `low_confidence` are
+listed for review.
+
+The field table is a CSV, TSV or Markdown table with the columns the prompt describes:
+`PDF Field Name`, `HTML Label`, `HTML Type` and `index`.
+
+Usage:
+    python form_mapping.py fields.csv mapping.json --shard-size 40 --concurrency 8
+"""
+
+import argparse
+import csv
+import json
+import math
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+
+from logprobs import LOW_CONFIDENCE_LOGPROB, LogprobCapture
+from sagemaker_utils import invoke_endpoint
+from stream_parser import ANSWER_DELTA, JsonStreamParser, ThinkStreamParser
+
+FIELD_COLUMNS = ("PDF Field Name", "HTML Label", "HTML Type", "index")
+DEFAULT_PROMPT = Path(__file__).parent / "share" / "prompt.txt"
+
+
+def read_field_table(path: Path) -> list[dict]:
+    """Read the field table from CSV, TSV or a Markdown pipe table, sorted by index."""
+    text = path.read_text(encoding="utf-8")
+    if path.suffix in (".csv", ".tsv"):
+        delimiter = "\t" if path.suffix == ".tsv" else ","
+        rows = list(csv.DictReader(text.splitlines(), delimiter=delimiter))
+    else:
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        cells = [
+            [cell.strip() for cell in line.strip("|").split("|")]
+            for line in lines
+            if line.startswith("|") and not re.fullmatch(r"[|:\- ]+", line)
+        ]
+        rows = [dict(zip(cells[0], row)) for row in cells[1:]]
+    for row in rows:
+        row["index"] = int(row["index"])
+    return sorted(rows, key=lambda row: row["index"])
+
+
+def render_field_table(fields: list[dict]) -> str:
+    lines = [
+        "| " + " | ".join(FIELD_COLUMNS) + " |",
+        "|" + "---|" * len(FIELD_COLUMNS),
+    ]
+    for row in fields:
+        lines.append(
+            "| " + " | ".join(str(row.get(c, "")) for c in FIELD_COLUMNS) + " |"
+        )
+    return "\n".join(lines)
+
+
+def load_labels(system_prompt: str) -> set[str]:
+    """The label names listed in the system prompt."""
+    return set(re.findall(r"^Label: (.+?)\s*$", system_prompt, re.MULTILINE))
+
+
+def shard_fields(fields: list[dict], size: int) -> list[list[dict]]:
+    return [fields[i : i + size] for i in range(0, len(fields), size)]
+
+
+def parse_mappings(data) -> dict[int, str]:
+    """
+    Normalize the shapes the model answers with into `{index: label}`: a list of
+    `{"index", "label"}` objects, such a list under a `mappings` or `fields` key, or
+    an object from index to label.
+    """
+    if isinstance(data, dict):
+        for key in ("mappings", "fields", "classifications"):
+            if isinstance(data.get(key), list):
+                data = data[key]
+                break
+        else:
+            return {
+                int(index): label
+                for index, label in data.items()
+                if str(index).isdigit() and isinstance(label, str)
+            }
+    mappings = {}
+    for item in data if isinstance(data, list) else ():
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index", item.get("field_number"))
+        label = item.get("label", item.get("classification"))
+        if index is not None and isinstance(label, str):
+            try:
+                mappings[int(index)] = label
+            except (TypeError, ValueError):
+                continue
+    return mappings
+
+
+@dataclass
+class ShardResult:
+    fields: list[dict]
+    round: int
+    status: str = "ok"
+    error: str | None = None
+    mappings: dict[int, str] = field(default_factory=dict)
+    # Lowest token probability of each mapping's record, with `logprobs` requested.
+    confidence: dict[int, float] = field(default_factory=dict)
+    seconds: float = 0.0
+
+    def report(self) -> dict:
+        return {
+            "first": self.fields[0]["index"],
+            "last": self.fields[-1]["index"],
+            "fields": len(self.fields),
+            "round": self.round,
+            "status": self.status,
+            "error": self.error,
+            "seconds": round(self.seconds, 2),
+        }
+
+
+def run_shard(
+    fields: list[dict],
+    round_no: int,
+    system_prompt: str,
+    labels: set[str],
+    params: dict,
+    total: int,
+) -> ShardResult:
+    result = ShardResult(fields, round_no)
+    start = time.perf_counter()
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {
+            "role": "user",
+            "content": (
+                f"Fields {fields[0]['index']} to {fields[-1]['index']} of a form with "
+                f"{total} fields:\n\n{render_field_table(fields)}"
+            ),
+        },
+    ]
+    wanted = {row["index"] for row in fields}
+    logprobs = (
+        LogprobCapture(top_k=params.get("top_logprobs") or 0)
+        if params.get("logprobs")
+        else None
+    )
+    # Token position where the answer text not yet closed into a record starts.
+    mark = 0
+
+    def accept(events: list):
+        nonlocal mark
+        records = json_parser.feed_events(events)
+        window = None
+        if logprobs is not None:
+            tokens = logprobs.choice(0)
+            if records:
+                window = tokens.window(mark, len(tokens))
+            if records or not any(event.type == ANSWER_DELTA for event in events):
+                mark = len(tokens)
+        # Mappings are kept as they close, so a truncated answer still counts.
+        for key, value in records:
+            data = [value] if isinstance(value, dict) else {key: value}
+            for index, label in parse_mappings(data).items():
+                if index in wanted and label in labels:
+                    result.mappings[index] = label
+                    if window is not None:
+                        result.confidence[index] = window["min_prob"]
+
+    try:
+        parser = ThinkStreamParser()
+        json_parser = JsonStreamParser()
+        for chunk in invoke_endpoint(messages, logprob_capture=logprobs, **params):
+            accept(parser.feed(chunk))
+        accept(parser.close())
+        if not json_parser.complete:
+            result.status = "truncated"
+            result.error = (
+                f"answer cut off after {len(result.mappings)} of {len(wanted)} fields"
+            )
+            return result
+        missing = len(wanted) - len(result.mappings)
+        if missing:
+            result.status = "incomplete"
+            result.error = f"{missing} fields missing or with an unknown label"
+    except Exception as e:
+        result.status = "error"
+        result.error = str(e)
+    finally:
+        result.seconds = time.perf_counter() - start
+    return result
+
+
+def retry_shards(result: ShardResult) -> list[list[dict]]:
+    """The fields of `result` still without a label, split in half if it was cut off."""
+    remaining = [row for row in result.fields if row["index"] not in result.mappings]
+    if result.status == "truncated" and len(remaining) > 1:
+        half = (len(remaining) + 1) // 2
+        return [remaining[:half], remaining[half:]]
+    return [remaining] if remaining else []
+
+
+def map_form(
+    fields: list[dict],
+    system_prompt: str,
+    params: dict | None = None,
+    shard_size: int = 40,
+    concurrency: int = 4,
+    max_rounds: int = 3,
+    low_confidence: float = math.exp(LOW_CONFIDENCE_LOGPROB),
+) -> dict:
+    labels = load_labels(system_prompt)
+    mappings = {}
+    confidence = {}
+    reports = []
+    shards = shard_fields(fields, shard_size)
+    with ThreadPoolExecutor(concurrency) as pool:
+        for round_no in range(1, max_rounds + 1):
+            if not shards:
+                break
+            run = partial(
+                run_shard,
+                round_no=round_no,
+                system_prompt=system_prompt,
+                labels=labels,
+                params=params or {},
+                total=len(fields),
+            )
+            results = pool.map(run, shards)
+            shards = []
+            for result in results:
+                mappings.update(result.mappings)
+                confidence.update(result.confidence)
+                reports.append(result.report())
+                if result.status != "ok":
+                    print(
+                        f"Shard {result.fields[0]['index']}-"
+                        f"{result.fields[-1]['index']} {result.status}: {result.error}"
+                    )
+                    shards.extend(retry_shards(result))
+    return {
+        "mappings": [
+            {
+                "index": row["index"],
+                "PDF Field Name": row.get("PDF Field Name"),
+                "label": mappings[row["index"]],
+                **(
+                    {"confidence": round(confidence[row["index"]], 4)}
+                    if row["index"] in confidence
+                    else {}
+                ),
+            }
+            for row in fields
+            if row["index"] in mappings
+        ],
+        "unmapped": [row["index"] for row in fields if row["index"] not in mappings],
+        "low_confidence": [
+            index for index, prob in sorted(confidence.items()) if prob < low_confidence
+        ],
+        "shards": reports,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", type=Path, help="Field table (.csv, .tsv or .md)")
+    parser.add_argument("output", type=Path, help="JSON file to write the mapping to")
+    parser.add_argument("--shard-size", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--max-rounds",
+        type=int,
+        default=3,
+        help="Rounds of re-running failed or truncated shards, including the first",
+    )
+    parser.add_argument(
+        "--params", default="{}", help="JSON object of generation parameters"
+    )
+    parser.add_argument("--system-prompt", type=Path, default=DEFAULT_PROMPT)
+    args = parser.parse_args()
+
+    fields = read_field_table(args.input)
+    result = map_form(
+        fields,
+        args.system_prompt.read_text(encoding="utf-8"),
+        params=json.loads(args.params),
+        shard_size=args.shard_size,
+        concurrency=args.concurrency,
+        max_rounds=args.max_rounds,
+    )
+    args.output.write_text(json.dumps(result, indent=2), encoding="utf-8")
+    print(
+        f"Mapped {len(result['mappings'])} of {len(fields)} fields "
+        f"in {len(result['shards'])} shard runs"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+
+CONTEXT_WINDOW_TOKENS = int(os.environ.get("CONTEXT_WINDOW_TOKENS", 32768))
+DEFAULT_MAX_TOKENS = 1024
+# Headroom for the chat template and the error in the token estimate.
+SAFETY_MARGIN_TOKENS = 256
+TRUNCATION_MARKER = "[...]"
+DEFAULT_POLICY = os.environ.get("HISTORY_COMPACTION_POLICY", "drop_oldest")
+
+
+def estimate_tokens(message: dict) -> int:
+    """Rough token count: about 4 characters per token plus the chat template overhead."""
+    return len(message["content"] or "") // 4 + 4
+
+
+def history_budget(max_tokens: int | None) -> int:
+    return (
+        CONTEXT_WINDOW_TOKENS
+        - (max_tokens or DEFAULT_MAX_TOKENS)
+        - SAFETY_MARGIN_TOKENS
+    )
+
+
+def split_turns(messages: list[dict]) -> list[list[dict]]:
+    """Group messages into turns, each starting at a user message."""
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def drop_oldest(turns: list[list[dict]], budget: int) -> list[list[dict]]:
+    """Keep the newest whole turns that fit in the budget."""
+    kept = []
+    for turn in reversed(turns):
+        cost = sum(estimate_tokens(message) for message in turn)
+        if cost > budget:
+            break
+        kept.append(turn)
+        budget -= cost
+    return kept[::-1]
+
+
+def truncate_oldest(turns: list[list[dict]], budget: int) -> list[list[dict]]:
+    """
+    Like `drop_oldest`, but the newest turn that no longer fits is kept with each
+    message cut down to its tail, so the model still sees how that turn ended.
+    Messages that are already short enough, or whose content is not text, such as an
+    assistant message with only `tool_calls`, are kept as they are.
+    """
+    kept = drop_oldest(turns, budget)
+    if len(kept) == len(turns):
+        return kept
+    budget -= sum(estimate_tokens(m) for turn in kept for m in turn)
+    partial = turns[len(turns) - len(kept) - 1]
+    chars = (budget // len(partial) - 4) * 4 - len(TRUNCATION_MARKER)
+    if chars <= 0:
+        return kept
+    truncated = [
+        (
+            {**message, "content": TRUNCATION_MARKER + message["content"][-chars:]}
+            if isinstance(message["content"], str) and len(message["content"]) > chars
+            else message
+        )
+        for message in partial
+    ]
+    return [truncated] + kept
+
+
+COMPACTION_POLICIES = {
+    "drop_oldest": drop_oldest,
+    "truncate_oldest": truncate_oldest,
+}
+
+
+def compact_history(
+    messages: list[dict],
+    max_tokens: int | None = None,
+    policy: str = DEFAULT_POLICY,
+) -> list[dict]:
+    """
+    Fit the chat history into the context window left over after `max_tokens`.
+
+    The system prompt and the newest turn are always kept. Older turns are passed to
+    the compaction policy, a function from `COMPACTION_POLICIES` that returns the turns
+    to keep within the remaining token budget.
+    """
+    system = [m for m in messages[:1] if m["role"] == "system"]
+    turns = split_turns(messages[len(system) :])
+    if not turns:
+        return messages
+    budget = history_budget(max_tokens)
+    budget -= sum(estimate_tokens(m) for m in system + turns[-1])
+    older = turns[:-1]
+    if sum(estimate_tokens(m) for turn in older for m in turn) <= budget:
+        return messages
+    kept = COMPACTION_POLICIES[policy](older, max(budget, 0))
+    return system + [m for turn in kept + turns[-1:] for m in turn]
@@ -0,0 +1,329 @@
+"""
+End-to-end load test of the Blocks chat app against the local SageMaker stand-in.
+
+Starts `fake_sagemaker` in this process and `r1_demo_blocks.py` as a subprocess pointed
+at it, waits for the app's `/ready`, then runs `--sessions` concurrent simulated chat
+sessions through the app's Gradio API. Each session sends `--turns` messages with
+`--think-time` seconds between them. Reports p50/p95/p99 end-to-end latency (message
+sent to final update) and time to first UI update, the UI update rate, errors, and the
+app process's CPU and RSS sampled from /proc. The stand-in takes the same options as
+`fake_sagemaker.py serve`, so the endpoint's speed and failure rate can be varied.
+
+Usage:
+    python load_test.py --sessions 32 --turns 3 --ttft 0.8 --tokens-per-second 40
+    python load_test.py --url http://127.0.0.1:7860 --pid 12345 --sessions 8
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from gradio_client import Client
+
+from fake_sagemaker import FakeSageMaker, add_fake_arguments, fake_config
+
+APP = Path(__file__).parent / "r1_demo_blocks.py"
+
+
+@dataclass
+class TurnResult:
+    session: int
+    turn: int
+    latency: float | None = None
+    first_update: float | None = None
+    updates: int = 0
+    error: str | None = None
+
+    @property
+    def update_rate(self) -> float | None:
+        if self.updates < 2 or self.latency == self.first_update:
+            return None
+        return (self.updates - 1) / (self.latency - self.first_update)
+
+
+def percentiles(values: list[float]) -> dict | None:
+    """Nearest-rank p50, p95 and p99."""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return {
+        f"p{q}": round(values[max(math.ceil(q / 100 * len(values)) - 1, 0)], 3)
+        for q in (50, 95, 99)
+    }
+
+
+class ProcessSampler:
+    """Samples a process's CPU use and RSS from /proc on a background thread."""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_percent = []
+        self.rss_mb = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _cpu_seconds(self) -> float:
+        with open(f"/proc/{self.pid}/stat") as f:
+            # Fields after the parenthesized command name; utime and stime are 14 and 15.
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def _rss_mb(self) -> float:
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return 0.0
+
+    def _run(self):
+        try:
+            last_cpu, last_time = self._cpu_seconds(), time.perf_counter()
+            while not self._stop.wait(self.interval):
+                cpu, now = self._cpu_seconds(), time.perf_counter()
+                self.cpu_percent.append((cpu - last_cpu) / (now - last_time) * 100)
+                self.rss_mb.append(self._rss_mb())
+                last_cpu, last_time = cpu, now
+        except OSError:
+            # The process exited, or /proc is not available on this platform.
+            pass
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+        if not self.cpu_percent:
+            return {}
+        return {
+            "cpu_percent_mean": round(sum(self.cpu_percent) / len(self.cpu_percent), 1),
+            "cpu_percent_max": round(max(self.cpu_percent), 1),
+            "rss_mb_start": round(self.rss_mb[0], 1),
+            "rss_mb_peak": round(max(self.rss_mb), 1),
+        }
+
+
+def start_app(
+    app: Path, port: int, metrics_port: int, endpoint_url: str, log_path: Path
+) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "SAGEMAKER_ENDPOINT_URL": endpoint_url,
+        "GRADIO_SERVER_PORT": str(port),
+        "METRICS_PORT": str(metrics_port),
+        "SESSION_DB": str(log_path.with_suffix(".sqlite3")),
+    }
+    # The stand-in does not check signatures, but botocore needs something to sign with.
+    env.setdefault("AWS_ACCESS_KEY_ID", "load-test")
+    env.setdefault("AWS_SECRET_ACCESS_KEY", "load-test")
+    log = log_path.open("w")
+    return subprocess.Popen(
+        [sys.executable, str(app)],
+        cwd=app.parent,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def wait_ready(metrics_port: int, process: subprocess.Popen, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/ready"):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.5)
+    raise RuntimeError(f"The app was not ready after {timeout:.0f} s")
+
+
+def run_session(
+    session: int,
+    url: str,
+    args: argparse.Namespace,
+    params: dict,
+    start: threading.Barrier,
+) -> list[TurnResult]:
+    results = []
+    try:
+        client = Client(url, verbose=False)
+        session_id, _ = client.predict(
+            None, args.system_prompt, api_name="/load_session"
+        )
+    except Exception as e:
+        start.abort()
+        return [TurnResult(session, 0, error=f"session setup failed: {e}")]
+    try:
+        start.wait()
+    except threading.BrokenBarrierError:
+        return [TurnResult(session, 0, error="another session failed to start")]
+    # Spread the sessions' first messages over the ramp-up.
+    time.sleep(args.ramp * session / args.sessions)
+    for turn in range(args.turns):
+        result = TurnResult(session, turn)
+        results.append(result)
+        sent = time.perf_counter()
+        try:
+            client.predict(
+                f"Session {session}, turn {turn}: {args.message}",
+                "Text",
+                session_id,
+                api_name="/user_message",
+            )
+            job = client.submit(
+                session_id,
+                params,
+                args.flush_interval,
+                args.flush_tokens,
+                api_name="/process_llm_stream_async",
+            )
+            for _ in job:
+                if result.first_update is None:
+                    result.first_update = time.perf_counter() - sent
+                result.updates += 1
+            job.result()
+            result.latency = time.perf_counter() - sent
+        except Exception as e:
+            result.error = str(e) or type(e).__name__
+        time.sleep(args.think_time)
+    return results
+
+
+def report(
+    results: list[TurnResult],
+    wall: float,
+    client_cpu: float,
+    server: dict,
+    fake: dict | None,
+) -> dict:
+    ok = [r for r in results if r.error is None]
+    errors = [r.error for r in results if r.error is not None]
+    return {
+        "turns": len(results),
+        "turns_ok": len(ok),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "wall_s": round(wall, 2),
+        "turns_per_s": round(len(ok) / wall, 2) if wall else None,
+        "latency_s": percentiles([r.latency for r in ok]),
+        "first_update_s": percentiles([r.first_update for r in ok]),
+        "updates_per_s": percentiles([r.update_rate for r in ok]),
+        "ui_updates_total": sum(r.updates for r in results),
+        # Near 100% means this process, not the app, limited the run.
+        "load_generator_cpu_percent": (
+            round(client_cpu / wall * 100, 1) if wall else None
+        ),
+        "server": server,
+        "fake_sagemaker": fake,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=1.0,
+        help="Seconds between a session's turns",
+    )
+    parser.add_argument(
+        "--ramp", type=float, default=0.0, help="Seconds to spread session starts over"
+    )
+    parser.add_argument("--message", default="Which label fits a date of birth field?")
+    parser.add_argument("--system-prompt", default="You are a helpful assistant.")
+    parser.add_argument(
+        "--params",
+        default='{"max_tokens": 512, "stream": true}',
+        help="JSON object of generation parameters",
+    )
+    parser.add_argument("--flush-interval", type=float, default=50)
+    parser.add_argument("--flush-tokens", type=int, default=0)
+    parser.add_argument(
+        "--url", help="Drive an app that is already running instead of starting one"
+    )
+    parser.add_argument("--pid", type=int, help="Process to sample with --url")
+    parser.add_argument("--app", type=Path, default=APP)
+    parser.add_argument("--port", type=int, default=7870)
+    parser.add_argument("--metrics-port", type=int, default=9470)
+    parser.add_argument("--fake-port", type=int, default=8090)
+    parser.add_argument("--output", type=Path, help="Also write the report here")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+    params = json.loads(args.params)
+
+    fake = None
+    app = None
+    pid = args.pid
+    url = args.url
+    if url is None:
+        fake = FakeSageMaker(("127.0.0.1", args.fake_port), fake_config(args))
+        threading.Thread(target=fake.serve_forever, daemon=True).start()
+        log_path = Path(tempfile.mkdtemp(prefix="load_test_")) / "app.log"
+        app = start_app(
+            args.app,
+            args.port,
+            args.metrics_port,
+            f"http://127.0.0.1:{args.fake_port}",
+            log_path,
+        )
+        print(f"Started {args.app.name} (pid {app.pid}), logging to {log_path}")
+        pid = app.pid
+        url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        if app is not None:
+            wait_ready(args.metrics_port, app)
+        sampler = ProcessSampler(pid) if pid else None
+        start = threading.Barrier(args.sessions + 1)
+        with ThreadPoolExecutor(args.sessions) as pool:
+            futures = [
+                pool.submit(run_session, session, url, args, params, start)
+                for session in range(args.sessions)
+            ]
+            # The clock starts once every session has connected.
+            try:
+                start.wait()
+            except threading.BrokenBarrierError:
+                pass
+            if sampler is not None:
+                sampler.start()
+            began = time.perf_counter()
+            began_cpu = time.process_time()
+            results = [result for future in futures for result in future.result()]
+            wall = time.perf_counter() - began
+            client_cpu = time.process_time() - began_cpu
+        server = sampler.stop() if sampler is not None else {}
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+
+    result = report(results, wall, client_cpu, server, fake.stats() if fake else None)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        details = {
+            "config": vars(args),
+            **result,
+            "turn_results": [asdict(r) for r in results],
+        }
+        args.output.write_text(json.dumps(details, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import heapq
+import math
+from array import array
+from collections import defaultdict
+
+# Tokens the model gave less than even odds are counted as low confidence.
+LOW_CONFIDENCE_LOGPROB = math.log(0.5)
+
+
+class TokenLogprobs:
+    """
+    Logprobs of one choice's tokens, stored as flat typed-array columns.
+
+    Per token this keeps an interned token id, the character offset of the token in
+    the choice's text, its logprob and the `top_k` alternatives' ids and logprobs, so a
+    4k-token reasoning trace costs tens of kilobytes rather than thousands of dicts.
+    The mean logprob, the entropy over the top-k alternatives and the lowest-confidence
+    spans (runs of tokens below `low_confidence`, ranked by their total logprob) are
+    updated as tokens arrive.
+    """
+
+    def __init__(
+        self,
+        top_k: int = 0,
+        low_confidence: float = LOW_CONFIDENCE_LOGPROB,
+        max_spans: int = 5,
+    ):
+        self.top_k = top_k
+        self.low_confidence = low_confidence
+        self.max_spans = max_spans
+        self.vocab = {}
+        self.token_texts = []
+        self.token_ids = array("l")
+        self.offsets = array("l")
+        self.logprobs = array("f")
+        self.top_ids = array("l")
+        self.top_logprobs = array("f")
+        self.length = 0
+        self.sum_logprob = 0.0
+        self.min_logprob = 0.0
+        self.sum_entropy = 0.0
+        self.entropy_tokens = 0
+        self.low_confidence_tokens = 0
+        self._span = None
+        self._spans = []
+
+    def __len__(self) -> int:
+        return len(self.logprobs)
+
+    def _intern(self, token: str) -> int:
+        token_id = self.vocab.get(token)
+        if token_id is None:
+            token_id = self.vocab[token] = len(self.token_texts)
+            self.token_texts.append(token)
+        return token_id
+
+    def append(self, entry: dict):
+        """Add one `{"token", "logprob", "top_logprobs"}` entry of the stream."""
+        token = entry.get("token") or ""
+        logprob = entry.get("logprob")
+        if logprob is None:
+            return
+        position = len(self.logprobs)
+        self.token_ids.append(self._intern(token))
+        self.offsets.append(self.length)
+        self.logprobs.append(logprob)
+        self.length += len(token)
+        self.sum_logprob += logprob
+        self.min_logprob = min(self.min_logprob, logprob)
+
+        if self.top_k:
+            top = (entry.get("top_logprobs") or [])[: self.top_k]
+            for alternative in top:
+                self.top_ids.append(self._intern(alternative.get("token") or ""))
+                alternative_logprob = alternative.get("logprob")
+                self.top_logprobs.append(
+                    -math.inf if alternative_logprob is None else alternative_logprob
+                )
+            padding = self.top_k - len(top)
+            self.top_ids.extend([-1] * padding)
+            self.top_logprobs.extend([-math.inf] * padding)
+            if top:
+                self.sum_entropy += _entropy([a.get("logprob") for a in top])
+                self.entropy_tokens += 1
+
+        if logprob < self.low_confidence:
+            self.low_confidence_tokens += 1
+            if self._span is None:
+                self._span = [position, 0.0]
+            self._span[1] += logprob
+        elif self._span is not None:
+            self._end_span(position)
+
+    def extend(self, entries: list[dict]):
+        for entry in entries:
+            self.append(entry)
+
+    def _end_span(self, end: int):
+        start, total = self._span
+        self._span = None
+        # Min-heap on surprisal keeps the `max_spans` least likely spans.
+        item = (-total, start, end)
+        if len(self._spans) < self.max_spans:
+            heapq.heappush(self._spans, item)
+        elif item > self._spans[0]:
+            heapq.heapreplace(self._spans, item)
+
+    def text(self, start: int = 0, end: int | None = None) -> str:
+        return "".join(self.token_texts[i] for i in self.token_ids[start:end])
+
+    def window(self, start: int, end: int | None = None) -> dict | None:
+        """Min and mean probability of tokens `start` to `end`, e.g. one JSON record."""
+        logprobs = self.logprobs[start:end]
+        if not logprobs:
+            return None
+        return {
+            "min_prob": math.exp(min(logprobs)),
+            "mean_prob": math.exp(sum(logprobs) / len(logprobs)),
+        }
+
+    def lowest_confidence_spans(self) -> list[dict]:
+        spans = list(self._spans)
+        if self._span is not None:
+            start, total = self._span
+            spans.append((-total, start, len(self.logprobs)))
+        spans = heapq.nlargest(self.max_spans, spans)
+        return [
+            {
+                "text": self.text(start, end),
+                "offset": self.offsets[start],
+                "tokens": end - start,
+                "mean_logprob": -surprisal / (end - start),
+                "min_prob": math.exp(min(self.logprobs[start:end])),
+            }
+            for surprisal, start, end in spans
+        ]
+
+    def summary(self) -> dict:
+        tokens = len(self.logprobs)
+        mean = self.sum_logprob / tokens if tokens else None
+        return {
+            "tokens": tokens,
+            "mean_logprob": mean,
+            "perplexity": math.exp(-mean) if mean is not None else None,
+            "min_prob": math.exp(self.min_logprob) if tokens else None,
+            "mean_entropy": (
+                self.sum_entropy / self.entropy_tokens if self.entropy_tokens else None
+            ),
+            "low_confidence_tokens": self.low_confidence_tokens,
+            "lowest_confidence_spans": self.lowest_confidence_spans(),
+        }
+
+    def footer(self) -> str:
+        s = self.summary()
+        if not s["tokens"]:
+            return ""
+        footer = (
+            f"mean p {math.exp(s['mean_logprob']):.2f} · "
+            f"{s['low_confidence_tokens']} tokens with p < "
+            f"{math.exp(self.low_confidence):.2f}"
+        )
+        if s["lowest_confidence_spans"]:
+            span = s["lowest_confidence_spans"][0]
+            footer += (
+                f" · least sure: “{span['text'].strip()}” (p {span['min_prob']:.2f})"
+            )
+        return footer
+
+
+def _entropy(logprobs: list[float | None]) -> float:
+    """Entropy in nats of the distribution renormalized over the top-k alternatives."""
+    probs = [math.exp(lp) for lp in logprobs if lp is not None]
+    mass = sum(probs)
+    if not mass:
+        return 0.0
+    return -sum(p / mass * math.log(p / mass) for p in probs if p)
+
+
+class LogprobCapture:
+    """`TokenLogprobs` per choice index, filled by `decode_line` while streaming."""
+
+    def __init__(self, top_k: int = 0, low_confidence: float = LOW_CONFIDENCE_LOGPROB):
+        self.choices = defaultdict(
+            lambda: TokenLogprobs(top_k=top_k, low_confidence=low_confidence)
+        )
+
+    def observe(self, index: int, logprobs: dict | None):
+        if logprobs and logprobs.get("content"):
+            self.choices[index].extend(logprobs["content"])
+
+    def reset(self):
+        """Forget the tokens so far, e.g. those of a response that called tools."""
+        self.choices.clear()
+
+    def choice(self, index: int = 0) -> TokenLogprobs:
+        return self.choices[index]
+
+    def summary(self) -> dict:
+        return {
+            index: choice.summary() for index, choice in sorted(self.choices.items())
+        }
@@ -0,0 +1,327 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from startup import profile, readiness
+from stream_parser import ANSWER_DELTA, THINKING_DELTA
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+
+# `RequestMetrics.finish()` logs each request here at INFO. Nothing is shown unless
+# `log_request_metrics()` is called, as the chat apps do, so benchmarks and batch
+# tools stay quiet.
+logger = logging.getLogger("request_metrics")
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RATE_BUCKETS = (5, 10, 20, 40, 80, 160, 320)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class MetricsRegistry:
+    """Process-wide request metrics in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter("r1_requests_total", "Endpoint requests")
+        self.cache_hits = Counter(
+            "r1_cache_hits_total", "Requests replayed from the response cache"
+        )
+        self.tokens = Counter("r1_tokens_total", "Streamed content chunks")
+        self.cancelled = Counter(
+            "r1_cancelled_requests_total",
+            "Requests whose stream was closed before it finished",
+        )
+        self.cancel_saved_tokens = Counter(
+            "r1_cancel_saved_tokens_total",
+            "Upper bound on tokens not generated thanks to cancellation",
+        )
+        self.queue_wait = Histogram(
+            "r1_queue_wait_seconds",
+            "Time spent in the admission queue before the request was sent",
+            LATENCY_BUCKETS,
+        )
+        self.first_byte = Histogram(
+            "r1_time_to_first_byte_seconds",
+            "Time from request to the first response stream event",
+            LATENCY_BUCKETS,
+        )
+        self.first_thinking = Histogram(
+            "r1_time_to_first_thinking_token_seconds",
+            "Time from request to the first thinking token",
+            LATENCY_BUCKETS,
+        )
+        self.first_answer = Histogram(
+            "r1_time_to_first_answer_token_seconds",
+            "Time from request to the first answer token",
+            LATENCY_BUCKETS,
+        )
+        self.inter_token = Histogram(
+            "r1_inter_token_latency_seconds",
+            "Time between consecutive content chunks",
+            INTER_TOKEN_BUCKETS,
+        )
+        self.tokens_per_second = Histogram(
+            "r1_tokens_per_second", "Per-request streaming rate", RATE_BUCKETS
+        )
+        self.payload_bytes = Histogram(
+            "r1_payload_bytes", "Request body size", SIZE_BUCKETS
+        )
+        self._metrics = [
+            self.requests,
+            self.cache_hits,
+            self.cancelled,
+            self.cancel_saved_tokens,
+            self.tokens,
+            self.queue_wait,
+            self.first_byte,
+            self.first_thinking,
+            self.first_answer,
+            self.inter_token,
+            self.tokens_per_second,
+            self.payload_bytes,
+        ]
+
+    def record(self, request: "RequestMetrics"):
+        with self._lock:
+            self.requests.inc()
+            self.tokens.inc(request.tokens)
+            self.inter_token.merge(request.inter_token)
+            if request.cancelled:
+                self.cancelled.inc()
+                self.cancel_saved_tokens.inc(request.saved_tokens)
+            if request.cache_hit:
+                self.cache_hits.inc()
+                return
+            self.payload_bytes.observe(request.payload_bytes)
+            if request.queue_wait is not None:
+                self.queue_wait.observe(request.queue_wait)
+            if request.first_byte is not None:
+                self.first_byte.observe(request.first_byte)
+            if request.first_thinking is not None:
+                self.first_thinking.observe(request.first_thinking)
+            if request.first_answer is not None:
+                self.first_answer.observe(request.first_answer)
+            if request.tokens_per_second:
+                self.tokens_per_second.observe(request.tokens_per_second)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [line for metric in self._metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetrics:
+    """
+    Latency breakdown of a single streamed request.
+
+    `invoke_endpoint` records the payload size and encoding time, first byte and every
+    content chunk, and the chat handlers pass the think parser events to
+    `observe_events` for the first thinking and answer tokens. `finish()` logs one
+    JSON line and adds the request to the process-wide registry.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.payload_bytes = 0
+        self.payload_encode = None
+        self.cache_hit = False
+        self.cancelled = False
+        self.saved_tokens = 0
+        self.queue_wait = None
+        self.first_byte = None
+        self.first_thinking = None
+        self.first_answer = None
+        self.tokens = 0
+        # Bucketed per request so memory stays flat however long the response is.
+        self.inter_token = Histogram(
+            "r1_inter_token_latency_seconds", "", INTER_TOKEN_BUCKETS
+        )
+        self.duration = None
+        self._last_token = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def mark_admitted(self):
+        """Note the time spent queueing and start the latency clock from here."""
+        self.queue_wait = self.elapsed()
+        self.start = time.perf_counter()
+
+    def mark_first_byte(self, event_stream):
+        """Wrap an event stream to note when its first event arrives."""
+        for event in event_stream:
+            if self.first_byte is None:
+                self.first_byte = self.elapsed()
+            yield event
+
+    async def amark_first_byte(self, event_stream):
+        async for event in event_stream:
+            if self.first_byte is None:
+                self.first_byte = self.elapsed()
+            yield event
+
+    def observe_token(self):
+        now = time.perf_counter()
+        if self._last_token is not None:
+            self.inter_token.observe(now - self._last_token)
+        self._last_token = now
+        self.tokens += 1
+
+    def observe_events(self, events: list):
+        for event in events:
+            if event.type == THINKING_DELTA and self.first_thinking is None:
+                self.first_thinking = self.elapsed()
+            elif event.type == ANSWER_DELTA and self.first_answer is None:
+                self.first_answer = self.elapsed()
+
+    def cancel(self, token_budget: int):
+        """
+        Mark the request as cancelled by the client. The endpoint could still have
+        generated up to `token_budget` tokens, less what it already sent.
+        """
+        self.cancelled = True
+        self.saved_tokens = max(0, token_budget - self.tokens)
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.duration if self.duration else 0.0
+
+    def summary(self) -> dict:
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+
+        return {
+            "cache_hit": self.cache_hit,
+            "cancelled": self.cancelled,
+            "payload_bytes": self.payload_bytes,
+            "payload_encode_ms": ms(self.payload_encode),
+            "queue_wait_ms": ms(self.queue_wait),
+            "time_to_first_byte_ms": ms(self.first_byte),
+            "time_to_first_thinking_ms": ms(self.first_thinking),
+            "time_to_first_answer_ms": ms(self.first_answer),
+            "duration_ms": ms(self.duration),
+            "tokens": self.tokens,
+            "tokens_per_second": round(self.tokens_per_second, 1),
+        }
+
+    def footer(self) -> str:
+        s = self.summary()
+        return (
+            f"TTFB {s['time_to_first_byte_ms']} ms · "
+            f"first answer {s['time_to_first_answer_ms']} ms · "
+            f"{s['tokens']} tokens · {s['tokens_per_second']} tok/s"
+        )
+
+    def finish(self):
+        if self.duration is not None:
+            return
+        self.duration = self.elapsed()
+        registry.record(self)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(self.summary()))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            status = 200
+            body = registry.render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/ready":
+            # 503 until the clients are warm and the UI is listening.
+            ready = readiness.status()
+            status = 200 if ready["ready"] else 503
+            body = json.dumps({**ready, "startup": profile.report()}).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def log_request_metrics():
+    """Print a `request_metrics {...}` line to stdout for every finished request."""
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(name)s %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = "127.0.0.1"):
+    """Serve `/metrics` for Prometheus scraping and `/ready` from a daemon thread."""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"Metrics server not started on {host}:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
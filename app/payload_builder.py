@@ -0,0 +1,139 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+# Separators of the normalized encoding `ResponseCache.key` hashes.
+KEY_SEPARATORS = (",", ":")
+
+
+@dataclass
+class EncodedPayload:
+    body: str
+    # The payload as `ResponseCache.key` encodes it before hashing.
+    key_json: str
+    seconds: float
+
+
+class PayloadBuilder:
+    """
+    Encodes request payloads, reusing the JSON of messages it has encoded before.
+
+    Every turn of a conversation resends the whole history, starting with the 15 KB
+    system prompt, so `json.dumps` of the payload grows with the session. Here each
+    `{"role", "content"}` message is encoded once, both as it appears in the request
+    body and in the sorted, compact form the response cache key is computed from, and
+    kept in an LRU bounded by `max_bytes`. A turn only encodes its new messages and
+    joins the cached ones. Since messages are keyed on their content rather than on a
+    session, the system prompt is also shared by every session and batch request. The
+    body is byte-identical to `json.dumps(payload)`.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._messages = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.messages_reused = 0
+        self.messages_encoded = 0
+        self.total_seconds = 0.0
+        self.last_seconds = None
+
+    def _encode_message(self, message: dict) -> tuple[str, str]:
+        """The message's body and cache key encodings, from the LRU if possible."""
+        if message.keys() != {"role", "content"} or not isinstance(
+            message["content"], str
+        ):
+            return json.dumps(message), json.dumps(
+                message, sort_keys=True, separators=KEY_SEPARATORS
+            )
+        key = (message["role"], message["content"])
+        with self._lock:
+            encoded = self._messages.get(key)
+            if encoded is not None:
+                self._messages.move_to_end(key)
+                self.messages_reused += 1
+                return encoded
+        encoded = (
+            json.dumps(message),
+            json.dumps(message, sort_keys=True, separators=KEY_SEPARATORS),
+        )
+        size = len(encoded[0]) + len(encoded[1])
+        with self._lock:
+            self.messages_encoded += 1
+            if key not in self._messages:
+                self._messages[key] = encoded
+                self._bytes += size
+                while self._bytes > self.max_bytes and self._messages:
+                    _, (body, key_json) = self._messages.popitem(last=False)
+                    self._bytes -= len(body) + len(key_json)
+        return encoded
+
+    def encode(self, payload: dict) -> EncodedPayload:
+        start = time.perf_counter()
+        messages = payload.get("messages")
+        if next(iter(payload), None) != "messages" or not isinstance(messages, list):
+            # Only the shape `build_payload` returns is assembled from parts.
+            body = json.dumps(payload)
+            key_json = json.dumps(
+                {k: v for k, v in payload.items() if k != "stream" and v is not None},
+                sort_keys=True,
+                separators=KEY_SEPARATORS,
+            )
+        else:
+            encoded = [self._encode_message(message) for message in messages]
+            params = {k: v for k, v in payload.items() if k != "messages"}
+            body = '{"messages": [' + ", ".join(body for body, _ in encoded) + "]"
+            body += ", " + json.dumps(params)[1:] if params else "}"
+            normalized = {
+                k: v for k, v in params.items() if k != "stream" and v is not None
+            }
+            normalized["messages"] = None
+            key_json = (
+                "{"
+                + ",".join(
+                    json.dumps(k)
+                    + ":"
+                    + (
+                        "[" + ",".join(key for _, key in encoded) + "]"
+                        if k == "messages"
+                        else json.dumps(v, sort_keys=True, separators=KEY_SEPARATORS)
+                    )
+                    for k, v in sorted(normalized.items())
+                )
+                + "}"
+            )
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.builds += 1
+            self.total_seconds += seconds
+            self.last_seconds = seconds
+        return EncodedPayload(body, key_json, seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "builds": self.builds,
+                "messages_reused": self.messages_reused,
+                "messages_encoded": self.messages_encoded,
+                "cached_messages": len(self._messages),
+                "cached_bytes": self._bytes,
+                "mean_encode_ms": (
+                    round(self.total_seconds / self.builds * 1000, 3)
+                    if self.builds
+                    else None
+                ),
+                "last_encode_ms": (
+                    round(self.last_seconds * 1000, 3)
+                    if self.last_seconds is not None
+                    else None
+                ),
+            }
+
+
+payload_builder = PayloadBuilder(
+    max_bytes=int(os.environ.get("PAYLOAD_CACHE_BYTES", 64 * 1024 * 1024)),
+)
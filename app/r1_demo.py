@@ -1,7 +1,23 @@
+import os
+import threading
+from contextlib import aclosing, closing
 from dataclasses import replace
-import gradio as gr
-from gradio import ChatMessage
-from sagemaker_utils import *
+
+from startup import launch, profile, start_warm_up
+
+with profile.phase("import sagemaker_utils"):
+    from metrics import log_request_metrics, start_metrics_server
+    from sagemaker_utils import *
+# Build the endpoint clients while gradio, by far the slowest import, loads.
+start_warm_up()
+start_metrics_server()
+log_request_metrics()
+with profile.phase("import gradio"):
+    import gradio as gr
+    from gradio import ChatMessage
+from admission import Overloaded, admission
+from metrics import RequestMetrics
+from stream_parser import FlushPolicy, ThinkStreamParser
 
 
 def insert_system_message(chat_history):
@@ -17,11 +33,33 @@ def insert_system_message(chat_history):
     return chat_history
 
 
-def process_llm_stream_interface(message, chat_history):
-    thinking = ""
-    answer = ""
-    buffer = ""
-    in_think = False
+def render_stream(
+    parser: ThinkStreamParser, thinking_message: ChatMessage, done: bool = False
+) -> list[ChatMessage]:
+    if done:
+        return [
+            replace(
+                thinking_message,
+                content=parser.thinking,
+                metadata={"title": "🤔 Thinking", "status": "done"},
+            ),
+            ChatMessage(role="assistant", content=parser.answer),
+        ]
+    if parser.in_think:
+        return [replace(thinking_message, content=parser.thinking)]
+    # Start yielding answer message once thinking is complete
+    return [
+        replace(thinking_message, content=parser.thinking),
+        ChatMessage(role="assistant", content=parser.answer),
+    ]
+
+
+def process_llm_stream_interface(
+    message, chat_history, request: gr.Request | None = None
+):
+    parser = ThinkStreamParser()
+    flush_policy = FlushPolicy()
+    metrics = RequestMetrics()
 
     # chat_history = insert_system_message(chat_history)
     chat_history.append({"role": "user", "content": message})
@@ -32,77 +70,107 @@ def process_llm_stream_interface(message, chat_history):
         metadata={"title": "🤔 Thinking", "status": "pending"},
     )
 
-    for chunk in invoke_endpoint(chat_history):
-        buffer += chunk
-
-        if not in_think and "<think>" in buffer:
-            in_think = True
-            buffer = buffer[buffer.index("<think>") + 7 :]
-
-        if in_think and "</think>" in buffer:
-            think_end = buffer.index("</think>")
-            thinking += buffer[:think_end]
-            answer += buffer[think_end + 8 :]
-            in_think = False
-            buffer = ""
-            # Start yielding answer message once thinking is complete
-            yield [
-                replace(
-                    thinking_message,
-                    content=thinking,
-                    # metadata={"title": "🤔 Thinking", "status": "done"},
-                ),
-                ChatMessage(role="assistant", content=answer),
-            ]
-        elif in_think:
-            thinking += buffer
-            buffer = ""
-            yield [replace(thinking_message, content=thinking)]
-        else:
-            answer += buffer
-            buffer = ""
-            yield [
-                replace(
-                    thinking_message,
-                    content=thinking,
-                    # metadata={"title": "🤔 Thinking", "status": "done"},
-                ),
-                ChatMessage(role="assistant", content=answer),
-            ]
-    yield [
-        replace(
-            thinking_message,
-            content=thinking,
-            metadata={"title": "🤔 Thinking", "status": "done"},
-        ),
-        ChatMessage(role="assistant", content=answer),
-    ]
+    try:
+        ticket = admission.enqueue(None, getattr(request, "session_hash", None))
+    except Overloaded as e:
+        raise gr.Error(str(e))
+    try:
+        for status in admission.wait(ticket):
+            yield [ChatMessage(role="assistant", content=status.message())]
+        metrics.mark_admitted()
+        # Closing the stream on cancel or edit stops the endpoint generating for it.
+        with closing(
+            invoke_endpoint(chat_history, metrics=metrics, ticket=ticket)
+        ) as stream:
+            for chunk in stream:
+                events = parser.feed(chunk)
+                metrics.observe_events(events)
+                if flush_policy.should_flush(events):
+                    yield render_stream(parser, thinking_message)
+    finally:
+        admission.release(ticket)
+        # Cancelled and failed requests still count towards the update counters.
+        parser.close()
+        flush_policy.finish()
+    yield render_stream(parser, thinking_message, done=True)
+
+
+async def process_llm_stream_interface_async(
+    message, chat_history, request: gr.Request | None = None
+):
+    parser = ThinkStreamParser()
+    flush_policy = FlushPolicy()
+    metrics = RequestMetrics()
+
+    # chat_history = insert_system_message(chat_history)
+    chat_history.append({"role": "user", "content": message})
 
+    thinking_message = ChatMessage(
+        role="assistant",
+        content="",
+        metadata={"title": "🤔 Thinking", "status": "pending"},
+    )
+
+    try:
+        ticket = admission.enqueue(None, getattr(request, "session_hash", None))
+    except Overloaded as e:
+        raise gr.Error(str(e))
+    try:
+        async for status in admission.await_admission(ticket):
+            yield [ChatMessage(role="assistant", content=status.message())]
+        metrics.mark_admitted()
+        async with aclosing(
+            ainvoke_endpoint(chat_history, metrics=metrics, ticket=ticket)
+        ) as stream:
+            async for chunk in stream:
+                events = parser.feed(chunk)
+                metrics.observe_events(events)
+                if flush_policy.should_flush(events):
+                    yield render_stream(parser, thinking_message)
+    finally:
+        admission.release(ticket)
+        # Cancelled and failed requests still count towards the update counters.
+        parser.close()
+        flush_policy.finish()
+    yield render_stream(parser, thinking_message, done=True)
+
+
+EXAMPLES = [
+    """If i have 3 fruits, an apple, two bananas and an orange on a green plate in a kitchen with a water leak from the ceiling and i climb up on a ladder carrying the plate and then flipping it upside down before using it to stop the water leak by taping it to the ceiling, how many fruits are on the plate when i get off the ladder?""",
+    """If i have a plate with 5 fruits and 3 vegetables and i pick it up and flip it upside down, put a cup of water on top of the plate, then vigorously shake the plate with two hands, how many fruits are in the water after flipping the plate right side up again?"""
+    """Lets play a game where there is a 20 sided die on a table. It starts with a random number facing up. You can choose to collect the amount in dollars shown by the die which counts for a turn, or you can use your turn to reroll the die try to collect a higher amount on your next turn. After collecting the money, you do not have to reroll the die if you dont want to. You have 100 turns to maximize the amount of money you can make, what strategy should you use to maximize earnings, and how much can you expect to earn with this strategy? For example, if the dice starts with the number 5 facing up, you could collect $5 100 times for a total of $500, or you could try to roll to get a higher number and use your remaining turns to collect. a key aspect of the problem is that you dont have to reroll if you dont want to and can just successively keep collecting the amount from a previous roll. Lets say it takes you 10 turns to roll the number 18, then you have 90 turns left to just repeatedly collect $18. Formalize this and solve it mathematically""",
+]
+
+
+with profile.phase("build UI"):
+    demo = gr.ChatInterface(
+        fn=process_llm_stream_interface_async,
+        chatbot=gr.Chatbot(
+            type="messages",
+            value=[
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant. Always delimit latex with $$ and $$.",
+                }
+            ],
+            height="85vh",
+            resizeable=True,
+            show_label=False,
+            bubble_full_width=False,
+            avatar_images=(None, "share/deepseek-logo-icon.svg"),
+        ),
+        fill_height=True,
+        editable=True,
+        concurrency_limit=None,
+        examples=EXAMPLES,
+        example_labels=["Fruit on plate", "Fruit on a plate (pt. 2)", "Dice game"],
+    )
 
-demo = gr.ChatInterface(
-    fn=process_llm_stream_interface,
-    chatbot=gr.Chatbot(
-        type="messages",
-        value=[
-            {
-                "role": "system",
-                "content": "You are a helpful assistant. Always delimit latex with $$ and $$.",
-            }
-        ],
-        height="85vh",
-        resizeable=True,
-        show_label=False,
-        bubble_full_width=False,
-        avatar_images=(None, "share/deepseek-logo-icon.svg"),
-    ),
-    fill_height=True,
-    editable=True,
-    examples=[
-        """If i have 3 fruits, an apple, two bananas and an orange on a green plate in a kitchen with a water leak from the ceiling and i climb up on a ladder carrying the plate and then flipping it upside down before using it to stop the water leak by taping it to the ceiling, how many fruits are on the plate when i get off the ladder?""",
-        """If i have a plate with 5 fruits and 3 vegetables and i pick it up and flip it upside down, put a cup of water on top of the plate, then vigorously shake the plate with two hands, how many fruits are in the water after flipping the plate right side up again?"""
-        """Lets play a game where there is a 20 sided die on a table. It starts with a random number facing up. You can choose to collect the amount in dollars shown by the die which counts for a turn, or you can use your turn to reroll the die try to collect a higher amount on your next turn. After collecting the money, you do not have to reroll the die if you dont want to. You have 100 turns to maximize the amount of money you can make, what strategy should you use to maximize earnings, and how much can you expect to earn with this strategy? For example, if the dice starts with the number 5 facing up, you could collect $5 100 times for a total of $500, or you could try to roll to get a higher number and use your remaining turns to collect. a key aspect of the problem is that you dont have to reroll if you dont want to and can just successively keep collecting the amount from a previous roll. Lets say it takes you 10 turns to roll the number 18, then you have 90 turns left to just repeatedly collect $18. Formalize this and solve it mathematically""",
-    ],
-    example_labels=["Fruit on plate", "Fruit on a plate (pt. 2)", "Dice game"],
-)
-
-demo.launch()
+if os.environ.get("PREWARM_EXAMPLES"):
+    # Example clicks start from an empty history, so cache exactly that request.
+    threading.Thread(
+        target=prewarm_cache,
+        args=([[{"role": "user", "content": example}] for example in EXAMPLES],),
+        daemon=True,
+    ).start()
+launch(demo)
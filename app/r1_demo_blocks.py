@@ -1,7 +1,33 @@
-from dataclasses import replace
-import gradio as gr
-from gradio import ChatMessage
-from sagemaker_utils import *
+import asyncio
+import functools
+import os
+import uuid
+from contextlib import aclosing, closing
+from dataclasses import asdict, replace
+
+from startup import launch, profile, start_warm_up
+
+with profile.phase("import sagemaker_utils"):
+    from metrics import log_request_metrics, start_metrics_server
+    from sagemaker_utils import *
+# Build the endpoint clients while gradio, by far the slowest import, loads.
+start_warm_up()
+start_metrics_server()
+log_request_metrics()
+with profile.phase("import gradio"):
+    import gradio as gr
+    from gradio import ChatMessage
+from admission import Overloaded, QueueStatus, Ticket, admission
+from logprobs import LogprobCapture
+from metrics import RequestMetrics
+from session_store import session_store
+from stream_parser import (
+    FlushPolicy,
+    JsonStreamParser,
+    ThinkStreamParser,
+    update_counters,
+)
+from tools import TOOL_MESSAGE_TITLE, ToolCall, ToolStep, tool_executor, tool_registry
 
 
 def insert_system_message(chat_history, system_prompt: str | None = None):
@@ -29,78 +55,358 @@ def clear_history():
     return []
 
 
-def user_message(
-    message: str, history: list[ChatMessage], mode: str, system_prompt: str
-):
+def load_session(session_id: str | None, system_prompt: str):
+    """Restore the browser's session from the store, or start a new one."""
+    # Gradio runs sync handlers like this one on worker threads, off the event loop.
+    session_id = session_id or uuid.uuid4().hex
+    history = session_store.load(session_id)
+    if not history:
+        history = insert_system_message([], system_prompt)
+        session_store.append(session_id, history)
+    return session_id, history
+
+
+def reset_session(session_id: str, system_prompt: str):
+    session_store.replace(session_id, insert_system_message([], system_prompt))
+
+
+def set_system_prompt(system_prompt: str, session_id: str):
+    history = session_store.load(session_id)
+    if not history or history[0] != {"role": "system", "content": system_prompt}:
+        session_store.replace(session_id, insert_system_message(history, system_prompt))
+
+
+def user_message(message: str, mode: str, session_id: str):
+    """
+    Store the message and clear the textbox. The chatbot shows the message already,
+    from `SHOW_USER_MESSAGE_JS`, so the history is not sent back to the browser.
+    """
     if mode == "Text":
-        return "", insert_system_message(history, system_prompt) + [
-            ChatMessage(role="user", content=message)
-        ]
+        session_store.append(session_id, [{"role": "user", "content": message}])
     else:
-        return "", json.loads(message)
+        session_store.replace(session_id, json.loads(message))
+    return ""
+
+
+# Runs in the browser before `user_message`: shows the message without a round trip.
+SHOW_USER_MESSAGE_JS = """
+(message, mode, history) => {
+    if (mode === "Text") {
+        return [...(history || []), {role: "user", content: message}];
+    }
+    try {
+        return JSON.parse(message);
+    } catch (e) {
+        return history;
+    }
+}
+"""
+
+
+def render_stream(
+    parser: ThinkStreamParser, thinking_message: ChatMessage, done: bool = False
+) -> list[ChatMessage]:
+    if done:
+        return [
+            replace(
+                thinking_message,
+                content=parser.thinking,
+                metadata={"title": "🤔 Thinking", "status": "done"},
+            ),
+            ChatMessage(role="assistant", content=parser.answer),
+        ]
+    if parser.in_think:
+        return [replace(thinking_message, content=parser.thinking)]
+    # Start yielding answer message once thinking is complete
+    return [
+        replace(thinking_message, content=parser.thinking),
+        ChatMessage(role="assistant", content=parser.answer),
+    ]
+
+
+MAX_COMPLETIONS = 5
 
 
-def process_llm_stream(chat_history, params: dict):
-    thinking = ""
-    answer = ""
-    buffer = ""
-    in_think = False
+def render_candidate(index: int, parser: ThinkStreamParser) -> str:
+    thinking = parser.thinking.strip()
+    details = (
+        f"<details><summary>🤔 Thinking</summary>\n\n{thinking}\n\n</details>\n\n"
+        if thinking
+        else ""
+    )
+    return f"**Candidate {index + 1}**\n\n{details}{parser.answer}"
+
 
-    thinking_message = ChatMessage(
+def render_tool_call(call: ToolCall, done: bool) -> ChatMessage:
+    run = call.timings(call.ready_at or 0)["run_ms"]
+    return ChatMessage(
         role="assistant",
-        content="",
-        metadata={"title": "🤔 Thinking", "status": "pending"},
+        content=f"```json\n{call.arguments}\n```\n\n{call.result or ''}",
+        metadata={
+            "title": f"{TOOL_MESSAGE_TITLE}: {call.name}",
+            "status": "done" if done else "pending",
+            **({"duration": run / 1000} if done and run is not None else {}),
+        },
     )
 
-    for chunk in invoke_endpoint(chat_history, **params):
-        buffer += chunk
-
-        if not in_think and "<think>" in buffer:
-            in_think = True
-            buffer = buffer[buffer.index("<think>") + 7 :]
-
-        if in_think and "</think>" in buffer:
-            think_end = buffer.index("</think>")
-            thinking += buffer[:think_end]
-            answer += buffer[think_end + 8 :]
-            in_think = False
-            buffer = ""
-            # Start yielding answer message once thinking is complete
-            yield chat_history + [
-                replace(
-                    thinking_message,
-                    content=thinking,
-                    # metadata={"title": "🤔 Thinking", "status": "done"},
-                ),
-                ChatMessage(role="assistant", content=answer),
+
+def render_records(records: list[tuple]) -> dict:
+    """Table of the parsed records: one column per key, or key and value columns."""
+    rows = [
+        value if isinstance(value, dict) else {"key": key, "value": value}
+        for key, value in records
+    ]
+    headers = list(dict.fromkeys(column for row in rows for column in row))
+    return {
+        "headers": headers,
+        "data": [
+            [
+                (
+                    json.dumps(row.get(column))
+                    if isinstance(row.get(column), (dict, list))
+                    else row.get(column)
+                )
+                for column in headers
             ]
-        elif in_think:
-            thinking += buffer
-            buffer = ""
-            yield chat_history + [replace(thinking_message, content=thinking)]
+            for row in rows
+        ],
+    }
+
+
+class ChatStream:
+    """
+    Turns the demultiplexed endpoint stream into Blocks updates.
+
+    Choice 0 is rendered into the chat history as usual. With `n > 1` every choice gets
+    its own parser and is rendered side by side in the candidates row.
+    """
+
+    def __init__(
+        self, chat_history, params: dict, flush_interval: float, flush_tokens: int
+    ):
+        self.chat_history = chat_history
+        self.n = min(int(params.get("n") or 1), MAX_COMPLETIONS)
+        self.parsers = [ThinkStreamParser() for _ in range(self.n)]
+        self.flush_policy = FlushPolicy(flush_interval, int(flush_tokens))
+        self.metrics = RequestMetrics()
+        # Structured answers are also parsed into records for the live table.
+        self.json_parser = JsonStreamParser() if params.get("response_format") else None
+        self.records = []
+        self._records_sent = 0
+        # Messages of the responses before each tool step, and the step itself.
+        self.tool_steps = []
+        self.logprobs = (
+            LogprobCapture(top_k=params.get("top_logprobs") or 0)
+            if params.get("logprobs")
+            else None
+        )
+        self.thinking_message = ChatMessage(
+            role="assistant",
+            content="",
+            metadata={"title": "🤔 Thinking", "status": "pending"},
+        )
+
+    def feed(self, index: int, chunk: str) -> bool:
+        if index >= self.n:
+            return False
+        events = self.parsers[index].feed(chunk)
+        self.metrics.observe_events(events)
+        if index == 0 and self.json_parser is not None:
+            self.records.extend(self.json_parser.feed_events(events))
+        return self.flush_policy.should_flush(events)
+
+    def close(self):
+        for index, parser in enumerate(self.parsers):
+            events = parser.close()
+            if index == 0 and self.json_parser is not None:
+                self.records.extend(self.json_parser.feed_events(events))
+        self.flush_policy.finish()
+
+    def tool_step(self, step: ToolStep) -> tuple:
+        """Show a step's tool calls, and stream the follow-up answer after them."""
+        if not self.tool_steps or self.tool_steps[-1][1] is not step:
+            messages = render_stream(self.parsers[0], self.thinking_message, done=True)
+            self.tool_steps.append(([m for m in messages if m.content], step))
+            self.parsers[0] = ThinkStreamParser()
+            self.thinking_message = replace(self.thinking_message, content="")
+        return self.update()
+
+    def previous_messages(self) -> list[ChatMessage]:
+        return [
+            message
+            for messages, step in self.tool_steps
+            for message in messages
+            + [render_tool_call(call, step.done) for call in step.calls.values()]
+        ]
+
+    def records_update(self):
+        if self.json_parser is None:
+            return gr.update(visible=False)
+        if self._records_sent == len(self.records):
+            return gr.skip()
+        self._records_sent = len(self.records)
+        return gr.update(visible=True, value=render_records(self.records))
+
+    def update(self, done: bool = False) -> tuple:
+        history = (
+            self.chat_history
+            + self.previous_messages()
+            + render_stream(self.parsers[0], self.thinking_message, done=done)
+        )
+        footer = self.footer() if done else gr.skip()
+        if self.n == 1:
+            candidates = [gr.update(visible=False)] + [gr.skip()] * MAX_COMPLETIONS
         else:
-            answer += buffer
-            buffer = ""
-            yield chat_history + [
-                replace(
-                    thinking_message,
-                    content=thinking,
-                    # metadata={"title": "🤔 Thinking", "status": "done"},
-                ),
-                ChatMessage(role="assistant", content=answer),
+            candidates = [gr.update(visible=True)] + [
+                (
+                    gr.update(visible=True, value=render_candidate(i, self.parsers[i]))
+                    if i < self.n
+                    else gr.update(visible=False)
+                )
+                for i in range(MAX_COMPLETIONS)
             ]
-    yield chat_history + [
-        replace(
-            thinking_message,
-            content=thinking,
-            metadata={"title": "🤔 Thinking", "status": "done"},
-        ),
-        ChatMessage(role="assistant", content=answer),
-    ]
+        return history, footer, self.records_update(), *candidates
+
+    def footer(self) -> str:
+        footer = self.metrics.footer()
+        if self.logprobs is not None and len(self.logprobs.choice(0)):
+            footer += " · " + self.logprobs.choice(0).footer()
+        if self.tool_steps:
+            summaries = [step.summary() for _, step in self.tool_steps]
+            calls = sum(len(summary["calls"]) for summary in summaries)
+            waited = sum(summary["wait_ms"] or 0 for summary in summaries)
+            ran = sum(summary["serial_run_ms"] for summary in summaries)
+            footer += (
+                f" · {calls} tool calls, {ran:.0f} ms of tool time, "
+                f"{waited:.0f} ms waited for results"
+            )
+        return footer
+
+    def messages(self) -> list[dict]:
+        """Choice 0's reply as stored in the session, without empty messages."""
+        return [
+            asdict(message)
+            for message in self.previous_messages()
+            + render_stream(self.parsers[0], self.thinking_message, done=True)
+            if message.content
+        ]
+
+    def queued(self, status: QueueStatus) -> tuple:
+        history = self.chat_history + [
+            ChatMessage(role="assistant", content=status.message())
+        ]
+        return history, gr.skip(), gr.skip(), *[gr.skip()] * (MAX_COMPLETIONS + 1)
+
+
+def enqueue(params: dict, request: gr.Request | None) -> Ticket:
+    try:
+        return admission.enqueue(
+            params.get("model"), getattr(request, "session_hash", None)
+        )
+    except Overloaded as e:
+        raise gr.Error(str(e))
+
+
+def process_llm_stream(
+    session_id: str,
+    params: dict,
+    flush_interval: float = 50,
+    flush_tokens: int = 0,
+    request: gr.Request | None = None,
+):
+    chat_history = session_store.load(session_id)
+    stream = ChatStream(chat_history, params, flush_interval, flush_tokens)
+    ticket = enqueue(params, request)
+    try:
+        for status in admission.wait(ticket):
+            yield stream.queued(status)
+        stream.metrics.mark_admitted()
+        # Closing the endpoint stream on Stop or Clear stops the endpoint generating for it.
+        invoke = invoke_with_tools if params.get("tools") else invoke_endpoint
+        with closing(
+            invoke(
+                chat_history,
+                metrics=stream.metrics,
+                logprob_capture=stream.logprobs,
+                demux=True,
+                ticket=ticket,
+                **params,
+            )
+        ) as chunks:
+            for item in chunks:
+                if isinstance(item, ToolStep):
+                    yield stream.tool_step(item)
+                elif stream.feed(*item):
+                    yield stream.update()
+    finally:
+        admission.release(ticket)
+        # Only the new reply is written; a stopped reply is kept as far as it got.
+        stream.close()
+        session_store.append(session_id, stream.messages(), at=len(chat_history))
+    yield stream.update(done=True)
+
+
+async def process_llm_stream_async(
+    session_id: str,
+    params: dict,
+    flush_interval: float = 50,
+    flush_tokens: int = 0,
+    request: gr.Request | None = None,
+):
+    # SQLite reads and commits would stall every other stream on the event loop.
+    chat_history = await asyncio.to_thread(session_store.load, session_id)
+    stream = ChatStream(chat_history, params, flush_interval, flush_tokens)
+    ticket = enqueue(params, request)
+    try:
+        async for status in admission.await_admission(ticket):
+            yield stream.queued(status)
+        stream.metrics.mark_admitted()
+        invoke = ainvoke_with_tools if params.get("tools") else ainvoke_endpoint
+        async with aclosing(
+            invoke(
+                chat_history,
+                metrics=stream.metrics,
+                logprob_capture=stream.logprobs,
+                demux=True,
+                ticket=ticket,
+                **params,
+            )
+        ) as chunks:
+            async for item in chunks:
+                if isinstance(item, ToolStep):
+                    yield stream.tool_step(item)
+                elif stream.feed(*item):
+                    yield stream.update()
+    finally:
+        admission.release(ticket)
+        # Only the new reply is written; a stopped reply is kept as far as it got.
+        stream.close()
+        # Shielded, so a second cancellation cannot lose the reply being saved.
+        await asyncio.shield(
+            asyncio.to_thread(
+                session_store.append,
+                session_id,
+                stream.messages(),
+                at=len(chat_history),
+            )
+        )
+    yield stream.update(done=True)
+
+
+@functools.cache
+def default_system_prompt() -> str:
+    """Read on the first page load rather than at import."""
+    return open("share/prompt.txt").read()
 
 
-with gr.Blocks() as demo:
+# Without a fixed secret the browser cannot decrypt its session ID after a restart.
+SESSION_SECRET = os.environ.get("SESSION_SECRET")
+
+with profile.phase("build UI"), gr.Blocks() as demo:
     gr.Markdown("# Reasoning LLM Chat")
+    session_id = gr.BrowserState(
+        None, storage_key="r1_session_id", secret=SESSION_SECRET
+    )
     with gr.Tab("Chat"):
         chatbot = gr.Chatbot(
             type="messages",
@@ -116,6 +422,15 @@ with gr.Blocks() as demo:
             resizeable=True,
             avatar_images=(None, "share/deepseek-logo-icon.svg"),
         )
+        stats_footer = gr.Markdown(elem_classes="stats-footer")
+        records_table = gr.Dataframe(
+            label="Structured Answer", visible=False, interactive=False, wrap=True
+        )
+        with gr.Row(visible=False) as candidates_row:
+            candidate_boxes = [
+                gr.Markdown(visible=False, container=True)
+                for _ in range(MAX_COMPLETIONS)
+            ]
 
         with gr.Row():
             msg = gr.Textbox(
@@ -132,6 +447,7 @@ with gr.Blocks() as demo:
                 container=False,
                 scale=0,
             )
+            stop = gr.Button("Stop", variant="stop", scale=0)
             clear = gr.ClearButton([msg, chatbot], scale=0)
 
         # examples = gr.Examples(
@@ -165,18 +481,15 @@ with gr.Blocks() as demo:
             system_message = gr.TextArea(
                 label="System Message",
                 placeholder="You are a helpful assistant.",
-                value=open("share/prompt.txt").read(),
+                value=default_system_prompt,
                 # value="You are a helpful assistant. Always delimit latex with $$ and $$.",
                 lines=15,
             )
             model = gr.Dropdown(
                 label="Model",
-                choices=[
-                    "xifin-reasoner-7b-endpoint",
-                    "xifin-chat-llama3-1-8b-instruct-endpoint",
-                ],
-                value="xifin-reasoner-7b-endpoint",
-                interactive=False,
+                choices=router.models(),
+                value=router.models()[0],
+                interactive=True,
             )
         with gr.Group():
             response_format = gr.TextArea(
@@ -249,6 +562,12 @@ with gr.Blocks() as demo:
                 placeholder="Enter tool prompt here",
                 info="Prompt to be appended before the tools",
             )
+            tools = gr.CheckboxGroup(
+                choices=tool_registry.names(),
+                value=[],
+                label="Tools",
+                info="Python tools the model may call; results are sent back to it",
+            )
 
         with gr.Accordion(label="Advanced Settings", open=False):
             with gr.Row():
@@ -294,6 +613,7 @@ with gr.Blocks() as demo:
                 n,
                 tool_choice,
                 tool_prompt,
+                tools,
                 response_format,
             },
             outputs=params_json,
@@ -329,6 +649,9 @@ with gr.Blocks() as demo:
             if data[tool_prompt]:
                 params["tool_prompt"] = data[tool_prompt]
 
+            if data[tools] and data[tool_choice] != "none":
+                params["tools"] = tool_registry.specs(data[tools])
+
             if data[response_format]:
                 try:
                     params["response_format"] = {
@@ -341,20 +664,103 @@ with gr.Blocks() as demo:
 
             return params
 
+        with gr.Group():
+            gr.Markdown("## Streaming")
+            with gr.Row():
+                flush_interval = gr.Slider(
+                    minimum=0,
+                    maximum=1000,
+                    value=50,
+                    step=10,
+                    label="UI Update Interval (ms)",
+                    info="Coalesce chunks into one chat update per interval",
+                )
+                flush_tokens = gr.Slider(
+                    minimum=0,
+                    maximum=100,
+                    value=0,
+                    step=1,
+                    label="Tokens per UI Update",
+                    info="Also update after this many chunks; set both to 0 to stream every token",
+                )
+
+        with gr.Accordion("Runtime Stats", open=False):
+            pool_stats = gr.JSON(label="SageMaker Client Pool Stats")
+            ui_update_stats = gr.JSON(label="UI Updates")
+            cache_stats = gr.JSON(label="Response Cache")
+            router_stats = gr.JSON(label="Endpoint Router")
+            retry_stats = gr.JSON(label="Retries and Hedging")
+            admission_stats = gr.JSON(label="Admission Queue")
+            session_stats = gr.JSON(label="Session Store")
+            payload_stats = gr.JSON(label="Payload Builder")
+            tool_stats = gr.JSON(label="Tools")
+            refresh_stats = gr.Button("Refresh", size="sm")
+            refresh_stats.click(
+                fn=lambda: (
+                    client_manager.stats(),
+                    update_counters.stats(),
+                    response_cache.stats(),
+                    router.stats(),
+                    retry_policy.stats(),
+                    admission.stats(),
+                    session_store.stats(),
+                    payload_builder.stats(),
+                    tool_executor.stats(),
+                ),
+                outputs=[
+                    pool_stats,
+                    ui_update_stats,
+                    cache_stats,
+                    router_stats,
+                    retry_stats,
+                    admission_stats,
+                    session_stats,
+                    payload_stats,
+                    tool_stats,
+                ],
+            )
+
         # Show/hide top_logprobs based on logprobs checkbox
         @gr.on(inputs=logprobs, outputs=top_logprobs)
         def toggle_logprobs(show_logprobs):
             return gr.update(visible=show_logprobs)
 
-    msg.submit(
-        fn=user_message,
-        inputs=[msg, chatbot, mode_selector, system_message],
-        outputs=[msg, chatbot],
-    ).then(
-        fn=process_llm_stream,
-        # fn=process_reasoning_stream,
-        inputs=[chatbot, params_json],
-        outputs=chatbot,
+    submit_event = (
+        msg.submit(
+            fn=None,
+            js=SHOW_USER_MESSAGE_JS,
+            inputs=[msg, mode_selector, chatbot],
+            outputs=[chatbot],
+        )
+        .then(
+            fn=user_message,
+            inputs=[msg, mode_selector, session_id],
+            outputs=[msg],
+        )
+        .then(
+            fn=process_llm_stream_async,
+            # fn=process_reasoning_stream,
+            inputs=[session_id, params_json, flush_interval, flush_tokens],
+            outputs=[
+                chatbot,
+                stats_footer,
+                records_table,
+                candidates_row,
+                *candidate_boxes,
+            ],
+            concurrency_limit=None,
+        )
+    )
+    # Cancelling the event closes the handler's endpoint stream.
+    stop.click(fn=None, cancels=[submit_event])
+    clear.click(fn=None, cancels=[submit_event])
+    clear.click(fn=reset_session, inputs=[session_id, system_message])
+    system_message.blur(fn=set_system_prompt, inputs=[system_message, session_id])
+    demo.load(
+        fn=load_session,
+        inputs=[session_id, system_message],
+        outputs=[session_id, chatbot],
     )
 
-demo.queue().launch()
+demo.queue()
+launch(demo)
@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+def is_deterministic(payload: dict) -> bool:
+    """Only greedy decoding or a fixed seed gives the same answer for the same payload."""
+    return payload.get("temperature") == 0 or payload.get("seed") is not None
+
+
+class ResponseCache:
+    """
+    Cache of streamed responses keyed on the normalized request payload.
+
+    Responses are stored as the list of content chunks the endpoint streamed, so a hit
+    can be replayed through the same handlers and the UI behaves exactly as for a live
+    request. Entries live in an in-memory LRU bounded by entry count and encoded size
+    and, when `cache_dir` is set, in one JSON file per entry on disk, evicted by age
+    (`ttl` seconds) and total size. The sizes of the files are read once at startup and
+    tracked as entries are written, so a write does not scan the directory; a directory
+    shared with other processes may briefly go over `max_disk_bytes`.
+
+    The async handlers use `aget()` and `aput()`, which do the disk I/O on a worker
+    thread.
+
+    Only deterministic payloads are stored, plus payloads explicitly pinned with `pin()`
+    such as prompts pre-warmed at startup.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_memory_bytes: int = 64 * 1024 * 1024,
+        cache_dir: str | None = None,
+        max_disk_bytes: int = 256 * 1024 * 1024,
+        ttl: float = 7 * 24 * 3600,
+    ):
+        self.max_entries = max_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # Disk entries oldest first, as key -> (mtime, size).
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    @staticmethod
+    def key(payload: dict) -> str:
+        normalized = {
+            k: v for k, v in payload.items() if k != "stream" and v is not None
+        }
+        encoded = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+        return ResponseCache.digest(encoded)
+
+    @staticmethod
+    def digest(encoded: str) -> str:
+        """The key of a payload already normalized and encoded as `key()` does."""
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def pin(self, key: str):
+        with self._lock:
+            self._pinned.add(key)
+
+    def should_store(self, key: str, payload: dict) -> bool:
+        # Only content is cached, so a replay could not give back logprobs or tool calls.
+        if payload.get("logprobs") or payload.get("tools"):
+            return False
+        return key in self._pinned or is_deterministic(payload)
+
+    def get(self, key: str) -> list | None:
+        chunks = self._get_memory(key)
+        if chunks is None:
+            chunks = self._get_disk(key)
+        return chunks
+
+    async def aget(self, key: str) -> list | None:
+        chunks = self._get_memory(key)
+        if chunks is None:
+            if self.cache_dir:
+                chunks = await asyncio.to_thread(self._get_disk, key)
+            else:
+                chunks = self._get_disk(key)
+        return chunks
+
+    def put(self, key: str, chunks: list):
+        encoded = json.dumps(chunks)
+        self._put_memory(key, chunks, len(encoded))
+        self._write_disk(key, encoded)
+
+    async def aput(self, key: str, chunks: list):
+        encoded = json.dumps(chunks)
+        self._put_memory(key, chunks, len(encoded))
+        if self.cache_dir:
+            await asyncio.to_thread(self._write_disk, key, encoded)
+
+    def _get_memory(self, key: str) -> list | None:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _get_disk(self, key: str) -> list | None:
+        read = self._read_disk(key)
+        if read is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        chunks, size = read
+        with self._lock:
+            self.hits += 1
+        self._put_memory(key, chunks, size)
+        return chunks
+
+    def _put_memory(self, key: str, chunks: list, size: int):
+        """Keep `chunks`, `size` bytes encoded, within both limits of the LRU."""
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous[1]
+            if size > self.max_memory_bytes:
+                return
+            self._memory[key] = (chunks, size)
+            self._memory_bytes += size
+            while (
+                len(self._memory) > self.max_entries
+                or self._memory_bytes > self.max_memory_bytes
+            ):
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _read_disk(self, key: str) -> tuple[list, int] | None:
+        """The entry's chunks and encoded size, unless it is missing or expired."""
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+                return None
+            text = path.read_text(encoding="utf-8")
+            return json.loads(text), len(text)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _write_disk(self, key: str, encoded: str):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        tmp = path.with_suffix(".tmp")
+        try:
+            tmp.write_text(encoded, encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Response cache write failed: {e}")
+            return
+        with self._lock:
+            self._forget_disk(key)
+            # `json.dumps` escapes non-ASCII, so characters are bytes.
+            self._disk[key] = (time.time(), len(encoded))
+            self._disk_bytes += self._disk[key][1]
+            evict = self._expired_disk_entries()
+        for evicted in evict:
+            self._path(evicted).unlink(missing_ok=True)
+
+    def _forget_disk(self, key: str):
+        entry = self._disk.pop(key, None)
+        if entry is not None:
+            self._disk_bytes -= entry[1]
+
+    def _expired_disk_entries(self) -> list[str]:
+        """Drop the oldest entries past the TTL or the size limit from the index."""
+        cutoff = time.time() - self.ttl
+        evict = []
+        while self._disk:
+            key, (mtime, _) = next(iter(self._disk.items()))
+            if mtime >= cutoff and self._disk_bytes <= self.max_disk_bytes:
+                break
+            self._forget_disk(key)
+            evict.append(key)
+        return evict
+
+    def _scan_disk(self):
+        """Index the files already in `cache_dir`, once at startup."""
+        entries = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path.stem))
+        with self._lock:
+            for mtime, size, key in sorted(entries):
+                self._disk[key] = (mtime, size)
+                self._disk_bytes += size
+            evict = self._expired_disk_entries()
+        for evicted in evict:
+            self._path(evicted).unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "pinned": len(self._pinned),
+                "disk": str(self.cache_dir) if self.cache_dir else None,
+            }
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get("RESPONSE_CACHE_ENTRIES", 256)),
+    max_memory_bytes=int(
+        os.environ.get("RESPONSE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024)
+    ),
+    cache_dir=os.environ.get("RESPONSE_CACHE_DIR"),
+    max_disk_bytes=int(os.environ.get("RESPONSE_CACHE_DISK_BYTES", 256 * 1024 * 1024)),
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 7 * 24 * 3600)),
+)
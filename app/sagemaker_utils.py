@@ -1,6 +1,227 @@
-import io
-import boto3
+import asyncio
+import contextlib
+import functools
 import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from json.decoder import scanstring
+
+from admission import Ticket, admission
+from endpoint_router import (
+    DEFAULT_ENDPOINT_NAME,
+    DEFAULT_REGION,
+    EndpointTarget,
+    is_retryable,
+    retry_policy,
+    router,
+)
+from history_compaction import DEFAULT_MAX_TOKENS, compact_history
+from logprobs import LogprobCapture
+from metrics import RequestMetrics
+from payload_builder import payload_builder
+from response_cache import response_cache
+from tools import TOOL_MAX_STEPS, ToolStep, is_tool_message
+
+
+@functools.cache
+def load_aiobotocore():
+    """Import aiobotocore on first use, or return None when it is not installed."""
+    try:
+        import aiobotocore.session
+    except ImportError:
+        return None
+    return aiobotocore.session
+
+
+class SageMakerClientManager:
+    """
+    Keeps long-lived, thread-safe `sagemaker-runtime` clients.
+
+    Creating a boto3 client resolves credentials, loads the service model and opens a
+    fresh connection pool, so doing it per chat turn adds a TLS handshake to every
+    time-to-first-token. boto3 clients are safe to share between threads once built, so
+    one client per (region, endpoint) is created lazily under a lock and reused.
+
+    The pool size should be at least the Gradio queue concurrency, otherwise concurrent
+    streams will wait on urllib3 for a free connection. Use `stats()` to size it.
+
+    boto3 and botocore's `Config` pull in most of botocore, so they are imported when
+    the first client is built rather than when this module is imported.
+
+    botocore's retries are disabled: `retry_policy` retries throttling, 5xx and
+    connection errors instead, failing over between targets first, and by default makes
+    as many attempts as botocore did. Set `RETRY_MAX` to change how many.
+
+    Set `SAGEMAKER_ENDPOINT_URL` to send every request to another runtime URL, such as
+    the local stand-in in `fake_sagemaker.py`.
+
+    Without aiobotocore, the async handlers call boto3 on `stream_executor`, a pool of
+    `SAGEMAKER_STREAM_THREADS` threads (by default the connection pool size). An open
+    stream holds one of them for as long as it waits for its next event, so this is
+    also the number of async streams that can be read at once; further streams wait
+    for a free thread.
+    """
+
+    def __init__(
+        self,
+        max_pool_connections: int = int(os.environ.get("SAGEMAKER_POOL_SIZE", 32)),
+        connect_timeout: float = float(os.environ.get("SAGEMAKER_CONNECT_TIMEOUT", 5)),
+        read_timeout: float = float(os.environ.get("SAGEMAKER_READ_TIMEOUT", 120)),
+        tcp_keepalive: bool = True,
+        endpoint_url: str | None = os.environ.get("SAGEMAKER_ENDPOINT_URL"),
+        stream_threads: int | None = int(os.environ.get("SAGEMAKER_STREAM_THREADS", 0)),
+    ):
+        self.endpoint_url = endpoint_url
+        self.stream_threads = stream_threads or max_pool_connections
+        self._stream_executor = None
+        self._stream_busy = 0
+        self.config_options = dict(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            tcp_keepalive=tcp_keepalive,
+            retries={"max_attempts": 0},
+        )
+        self._config = None
+        self._session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._peak_in_flight = {}
+        self._requests = {}
+        self._async_clients = {}
+        self._async_lock = asyncio.Lock()
+        self._async_exit_stack = contextlib.AsyncExitStack()
+
+    @property
+    def config(self):
+        if self._config is None:
+            from botocore.config import Config
+
+            self._config = Config(**self.config_options)
+        return self._config
+
+    @property
+    def stream_executor(self) -> ThreadPoolExecutor:
+        if self._stream_executor is None:
+            with self._lock:
+                if self._stream_executor is None:
+                    self._stream_executor = ThreadPoolExecutor(
+                        self.stream_threads, thread_name_prefix="stream"
+                    )
+        return self._stream_executor
+
+    async def run_in_stream_thread(self, function, *args, **kwargs):
+        """Run a blocking boto3 call on `stream_executor`."""
+
+        def run():
+            with self._lock:
+                self._stream_busy += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._stream_busy -= 1
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.stream_executor, run
+        )
+
+    def stream_threads_free(self) -> bool:
+        """Whether a stream call would start now rather than wait for a thread."""
+        return load_aiobotocore() is not None or self._stream_busy < self.stream_threads
+
+    def get_client(
+        self, region: str = DEFAULT_REGION, endpoint_name: str = DEFAULT_ENDPOINT_NAME
+    ):
+        key = (region, endpoint_name)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    if self._session is None:
+                        import boto3
+
+                        self._session = boto3.session.Session()
+                    client = self._session.client(
+                        "sagemaker-runtime",
+                        region_name=region,
+                        endpoint_url=self.endpoint_url,
+                        config=self.config,
+                    )
+                    self._clients[key] = client
+        return client
+
+    async def get_async_client(
+        self, region: str = DEFAULT_REGION, endpoint_name: str = DEFAULT_ENDPOINT_NAME
+    ):
+        """Long-lived aiobotocore client; only available when aiobotocore is installed."""
+        key = (region, endpoint_name)
+        client = self._async_clients.get(key)
+        if client is None:
+            async with self._async_lock:
+                client = self._async_clients.get(key)
+                if client is None:
+                    client = await self._async_exit_stack.enter_async_context(
+                        load_aiobotocore()
+                        .get_session()
+                        .create_client(
+                            "sagemaker-runtime",
+                            region_name=region,
+                            endpoint_url=self.endpoint_url,
+                            config=self.config,
+                        )
+                    )
+                    self._async_clients[key] = client
+        return client
+
+    async def aclose(self):
+        await self._async_exit_stack.aclose()
+        self._async_clients.clear()
+
+    def acquire(self, region: str, endpoint_name: str):
+        key = (region, endpoint_name)
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            self._peak_in_flight[key] = max(
+                self._peak_in_flight.get(key, 0), self._in_flight[key]
+            )
+        return self.get_client(region, endpoint_name)
+
+    def release(self, region: str, endpoint_name: str):
+        with self._lock:
+            self._in_flight[(region, endpoint_name)] -= 1
+
+    def warm_up(self, targets: list[tuple[str, str]] | None = None):
+        """Build clients ahead of the first request so the first user does not pay for it."""
+        targets = targets or [(DEFAULT_REGION, DEFAULT_ENDPOINT_NAME)]
+        for region, endpoint_name in targets:
+            self.get_client(region, endpoint_name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_pool_connections": self.config_options["max_pool_connections"],
+                "stream_threads": self.stream_threads,
+                "clients": len(self._clients),
+                "endpoints": {
+                    f"{region}/{endpoint}": {
+                        "requests": self._requests.get((region, endpoint), 0),
+                        "in_flight": self._in_flight.get((region, endpoint), 0),
+                        "peak_in_flight": self._peak_in_flight.get(
+                            (region, endpoint), 0
+                        ),
+                    }
+                    for region, endpoint in self._clients
+                },
+            }
+
+
+client_manager = SageMakerClientManager()
 
 
 class LineIterator:
@@ -23,38 +244,94 @@ class LineIterator:
     {'PayloadPart': {'Bytes': b'[" problem"]}\n'}}
     ```
 
-    This class accounts for this by concatenating bytes written via the 'write' function
-    and then exposing a method which will return lines (ending with a '\n' character) within
-    the buffer via the 'scan_lines' function. It maintains the position of the last read
-    position to ensure that previous bytes are not exposed again.
+    This class accounts for this by appending bytes written via the 'write' function to a
+    bytearray and returning complete lines (ending with a '\n' character) from it. Only
+    newly written bytes are scanned for a newline, and the consumed prefix is dropped on
+    each write, so the buffer never holds more than one partial line plus the latest part
+    and the cost per line does not depend on how long the response has been running.
     """
 
     def __init__(self, stream):
         self.byte_iterator = iter(stream)
-        self.buffer = io.BytesIO()
+        self.buffer = bytearray()
         self.read_pos = 0
+        self.scan_pos = 0
 
     def __iter__(self):
         return self
 
+    def write(self, data: bytes):
+        if self.read_pos:
+            # Deleting a bytearray prefix only moves the start pointer, no copy.
+            del self.buffer[: self.read_pos]
+            self.scan_pos -= self.read_pos
+            self.read_pos = 0
+        self.buffer += data
+
+    def scan_line(self) -> bytes | None:
+        newline = self.buffer.find(b"\n", self.scan_pos)
+        if newline == -1:
+            self.scan_pos = len(self.buffer)
+            return None
+        line = bytes(memoryview(self.buffer)[self.read_pos : newline])
+        self.read_pos = self.scan_pos = newline + 1
+        return line
+
+    def flush(self) -> bytes | None:
+        """Return the trailing bytes of a stream that did not end with a newline."""
+        if self.read_pos >= len(self.buffer):
+            return None
+        line = bytes(memoryview(self.buffer)[self.read_pos :])
+        self.buffer.clear()
+        self.read_pos = self.scan_pos = 0
+        return line
+
+    def _write_event(self, chunk: dict):
+        if "PayloadPart" not in chunk:
+            print("Unknown event type:" + str(chunk))
+            return
+        self.write(chunk["PayloadPart"]["Bytes"])
+
     def __next__(self):
         while True:
-            self.buffer.seek(self.read_pos)
-            line = self.buffer.readline()
-            if line and line[-1] == ord("\n"):
-                self.read_pos += len(line)
-                return line[:-1]
+            line = self.scan_line()
+            if line is not None:
+                return line
             try:
                 chunk = next(self.byte_iterator)
             except StopIteration:
-                if self.read_pos < self.buffer.getbuffer().nbytes:
-                    continue
+                line = self.flush()
+                if line is not None:
+                    return line
                 raise
-            if "PayloadPart" not in chunk:
-                print("Unknown event type:" + chunk)
-                continue
-            self.buffer.seek(0, io.SEEK_END)
-            self.buffer.write(chunk["PayloadPart"]["Bytes"])
+            self._write_event(chunk)
+
+
+class AsyncLineIterator(LineIterator):
+    """`LineIterator` over an async iterable of event stream events."""
+
+    def __init__(self, stream):
+        self.byte_iterator = aiter(stream)
+        self.buffer = bytearray()
+        self.read_pos = 0
+        self.scan_pos = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            line = self.scan_line()
+            if line is not None:
+                return line
+            try:
+                chunk = await anext(self.byte_iterator)
+            except StopAsyncIteration:
+                line = self.flush()
+                if line is not None:
+                    return line
+                raise
+            self._write_event(chunk)
 
 
 def is_thinking_message(message: dict) -> bool:
@@ -66,45 +343,676 @@ def is_thinking_message(message: dict) -> bool:
     return False
 
 
-def invoke_endpoint(history: list[dict[str, str]], **params):
-    endpoint_name = "xifin-reasoner-7b-endpoint"
-
-    payload = {
-        "messages": [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in history
-            if not is_thinking_message(msg)
-        ],
+def build_payload(history: list[dict[str, str]], **params) -> dict:
+    messages = [
+        {
+            "role": msg["role"],
+            "content": msg["content"],
+            **{key: msg[key] for key in ("tool_calls", "tool_call_id") if key in msg},
+        }
+        for msg in history
+        if not is_thinking_message(msg) and not is_tool_message(msg)
+    ]
+    return {
+        "messages": compact_history(messages, params.get("max_tokens")),
         **params,
         "stream": True,
     }
+
+
+def _fast_delta_content(line: bytes) -> list[tuple[int, str]] | None:
+    """
+    Pull the delta content out of a single-choice chunk without decoding the whole line.
+
+    Keys cannot occur unescaped inside JSON strings, so the first `"delta":` is the
+    delta of the chunk's choice and a single `"index":` is that choice's index. The
+    content string itself is decoded with the C string scanner used by `json.loads`.
+    Returns None whenever the line does not have that exact shape, and the caller
+    falls back to a full `json.loads`.
+    """
+    delta = line.find(b'"delta":')
+    if delta == -1:
+        return None
+    key = line.find(b'"content":', delta)
+    if key == -1:
+        return None
+    start = key + 10
+    while start < len(line) and line[start] in b" \t":
+        start += 1
+    if start >= len(line) or line[start] != 0x22:  # '"'
+        return None
+    index = 0
+    index_key = line.find(b'"index":')
+    if index_key != -1:
+        if line.find(b'"index":', index_key + 8) != -1:
+            return None
+        digits = line[index_key + 8 : index_key + 12].lstrip()
+        end = 0
+        while end < len(digits) and 0x30 <= digits[end] <= 0x39:
+            end += 1
+        if not end:
+            return None
+        index = int(digits[:end])
+    try:
+        text = str(memoryview(line)[start + 1 :], "utf-8")
+        content, _ = scanstring(text, 0)
+    except (UnicodeDecodeError, ValueError):
+        return None
+    return [(index, content)]
+
+
+_END_OF_STREAM = object()
+
+
+def decode_line(
+    line: bytes,
+    capture: LogprobCapture | None = None,
+    tool_step: ToolStep | None = None,
+):
+    """
+    Decode one line of the response stream into `(choice index, delta content)` pairs.
+
+    With a `capture`, lines are always decoded in full and each choice's logprobs are
+    added to it. With a `tool_step`, lines with tool calls are decoded in full and the
+    first choice is passed to it. Returns None for lines that carry no content and
+    `_END_OF_STREAM` when the endpoint reported an error and the stream should stop.
+    """
+    start_json = b"{"
+    if line == b"" or start_json not in line:
+        return None
+    if capture is None and (tool_step is None or b'"tool_calls"' not in line):
+        deltas = _fast_delta_content(line)
+        if deltas is not None:
+            return deltas
+    try:
+        data = json.loads(line[line.find(start_json) :].decode("utf-8"))
+        if "choices" in data:
+            if capture is not None:
+                for choice in data["choices"]:
+                    capture.observe(choice.get("index", 0), choice.get("logprobs"))
+            if tool_step is not None:
+                for choice in data["choices"]:
+                    if choice.get("index", 0) == 0:
+                        tool_step.observe(choice)
+            return [
+                (choice.get("index", 0), choice["delta"]["content"])
+                for choice in data["choices"]
+                if choice["delta"].get("content") is not None
+            ]
+        elif "error" in data:
+            print(f"Error encountered: {data['error']}")
+            return _END_OF_STREAM
+        else:
+            print("Unexpected data format:", data)
+    except json.JSONDecodeError as e:
+        print(f"JSON decode error: {e}")
+    except KeyError as e:
+        print(f"Key error: {e}")
+    except Exception as e:
+        print(f"Unexpected error: {e}")
+    return None
+
+
+def _replay(cached: list, metrics: RequestMetrics, demux: bool):
+    for index, content in cached:
+        metrics.observe_token()
+        if demux:
+            yield index, content
+        elif index == 0:
+            yield content
+
+
+class _Attempt:
+    """
+    One request to one endpoint target, from sending it to closing its stream.
+
+    `open()` / `aopen()` send the request and wait for the first stream event, so the
+    time to first byte is known before the attempt is committed to. `sent` is set, and
+    the latency clock started, when the request is actually sent, after any wait for a
+    free thread. `close()` releases the target however the attempt ended and is safe to
+    call from any thread.
+    """
+
+    def __init__(self, target: EndpointTarget, body: str):
+        self.target = target
+        self.body = body
+        self.response_body = None
+        self.events = None
+        self.first_event = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._loop = None
+        self.sent = threading.Event()
+        self.async_sent = asyncio.Event()
+        router.start(target)
+        client_manager.acquire(target.region, target.endpoint_name)
+
+    def _mark_sent(self):
+        self._start = time.perf_counter()
+        self.sent.set()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self.async_sent.set)
+
+    def _send(self, smr, request: dict):
+        self._mark_sent()
+        return smr.invoke_endpoint_with_response_stream(**request)
+
+    def _opened(self, first_event):
+        self.first_event = first_event
+        router.observe_latency(self.target, time.perf_counter() - self._start)
+        return self
+
+    def open(self) -> "_Attempt":
+        smr = client_manager.get_client(self.target.region, self.target.endpoint_name)
+        response_stream = self._send(smr, self.target.request(self.body))
+        self.response_body = response_stream["Body"]
+        self.events = iter(self.response_body)
+        return self._opened(next(self.events, None))
+
+    async def aopen(self) -> "_Attempt":
+        request = self.target.request(self.body)
+        self._loop = asyncio.get_running_loop()
+        if load_aiobotocore() is not None:
+            smr = await client_manager.get_async_client(
+                self.target.region, self.target.endpoint_name
+            )
+            self._mark_sent()
+            response_stream = await smr.invoke_endpoint_with_response_stream(**request)
+            self.response_body = response_stream["Body"]
+            self.events = aiter(self.response_body)
+        else:
+            smr = client_manager.get_client(
+                self.target.region, self.target.endpoint_name
+            )
+            call = asyncio.ensure_future(
+                client_manager.run_in_stream_thread(self._send, smr, request)
+            )
+            try:
+                response_stream = await asyncio.shield(call)
+            except asyncio.CancelledError:
+                # The thread cannot be stopped; close the stream it opens once it has.
+                call.add_done_callback(_close_response)
+                raise
+            self.response_body = response_stream["Body"]
+            self.events = _aiter_in_thread(self.response_body)
+        return self._opened(await anext(self.events, None))
+
+    def stream(self):
+        if self.first_event is not None:
+            yield self.first_event
+            yield from self.events
+
+    async def astream(self):
+        if self.first_event is not None:
+            yield self.first_event
+            async for event in self.events:
+                yield event
+
+    def close(self, error: Exception | None = None):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self.response_body is not None:
+            try:
+                self.response_body.close()
+            except Exception:
+                pass
+        client_manager.release(self.target.region, self.target.endpoint_name)
+        router.finish(self.target, error)
+
+
+def _close_response(future):
+    """Done callback closing the body of an abandoned `invoke_endpoint_*` call."""
+    if not future.cancelled() and future.exception() is None:
+        try:
+            future.result()["Body"].close()
+        except Exception:
+            pass
+
+
+def _close_loser(attempt: _Attempt, future):
+    """Done callback closing an attempt that lost the hedge, once it has opened."""
+    attempt.close(None if future.cancelled() else future.exception())
+
+
+# Threads that open hedged requests, each held until its stream's first event.
+HEDGE_THREADS = int(
+    os.environ.get(
+        "HEDGE_THREADS", client_manager.config_options["max_pool_connections"]
+    )
+)
+_hedge_pool = ThreadPoolExecutor(HEDGE_THREADS, thread_name_prefix="hedge")
+_hedge_lock = threading.Lock()
+_hedge_opening = 0
+
+
+def _open_in_hedge_pool(attempt: _Attempt) -> _Attempt:
+    global _hedge_opening
+    with _hedge_lock:
+        _hedge_opening += 1
     try:
-        smr = boto3.client("sagemaker-runtime", region_name="us-west-2")
-        response_stream = smr.invoke_endpoint_with_response_stream(
-            EndpointName=endpoint_name,
-            ContentType="application/json",
-            Body=json.dumps(payload),
-            CustomAttributes="accept_eula=true",
+        return attempt.open()
+    finally:
+        with _hedge_lock:
+            _hedge_opening -= 1
+        # Also when the attempt failed before sending, so nothing waits on it forever.
+        attempt.sent.set()
+
+
+def _open_attempt(targets: list[EndpointTarget], body: str) -> _Attempt:
+    """Open a stream on the best target, hedging onto the next one if it is slow."""
+    primary = _Attempt(targets[0], body)
+    if retry_policy.hedge_delay is None:
+        try:
+            return primary.open()
+        except Exception as E:
+            primary.close(E)
+            raise
+    attempts = {_hedge_pool.submit(_open_in_hedge_pool, primary): primary}
+    # The delay runs from when the request is sent, not from when it was queued for a
+    # thread, and there is no hedge while every thread is busy: the hedge would only
+    # queue too, and add load when the endpoints are already busy.
+    primary.sent.wait()
+    done, _ = wait(attempts, timeout=retry_policy.hedge_delay)
+    hedged = not done and _hedge_opening < HEDGE_THREADS
+    if hedged:
+        hedge = _Attempt(targets[1 % len(targets)], body)
+        attempts[_hedge_pool.submit(_open_in_hedge_pool, hedge)] = hedge
+    error = None
+    while attempts:
+        done, _ = wait(attempts, return_when=FIRST_COMPLETED)
+        for future in done:
+            attempt = attempts.pop(future)
+            if future.exception() is None:
+                for loser_future, loser in attempts.items():
+                    # The loser may still be opening; close its stream once it has.
+                    loser_future.add_done_callback(
+                        functools.partial(_close_loser, loser)
+                    )
+                if hedged:
+                    retry_policy.record_hedge(won=attempt is not primary)
+                return attempt
+            error = future.exception()
+            attempt.close(error)
+    if hedged:
+        retry_policy.record_hedge(won=False)
+    raise error
+
+
+async def _aopen_attempt(targets: list[EndpointTarget], body: str) -> _Attempt:
+    primary = _Attempt(targets[0], body)
+    if retry_policy.hedge_delay is None:
+        try:
+            return await primary.aopen()
+        except Exception as E:
+            primary.close(E)
+            raise
+    attempts = {asyncio.ensure_future(primary.aopen()): primary}
+    hedged = False
+    error = None
+    try:
+        # As in `_open_attempt`, time the delay from when the request is sent.
+        sent = asyncio.ensure_future(primary.async_sent.wait())
+        await asyncio.wait(
+            {next(iter(attempts)), sent}, return_when=asyncio.FIRST_COMPLETED
         )
-        event_stream = response_stream["Body"]
-        start_json = b"{"
-        for line in LineIterator(event_stream):
-            if line != b"" and start_json in line:
-                try:
-                    data = json.loads(line[line.find(start_json) :].decode("utf-8"))
-                    if "choices" in data:
-                        yield data["choices"][0]["delta"]["content"]
-                    elif "error" in data:
-                        print(f"Error encountered: {data['error']}")
-                        break  # or continue based on how you want to handle errors
-                    else:
-                        print("Unexpected data format:", data)
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error: {e}")
-                except KeyError as e:
-                    print(f"Key error: {e}")
-                except Exception as e:
-                    print(f"Unexpected error: {e}")
-    except Exception as E:
-        print("Exception while invoking llama3 endpoint: {}".format(str(E)))
-        raise Exception(E)
+        sent.cancel()
+        done, _ = await asyncio.wait(attempts, timeout=retry_policy.hedge_delay)
+        hedged = not done and client_manager.stream_threads_free()
+        if hedged:
+            hedge = _Attempt(targets[1 % len(targets)], body)
+            attempts[asyncio.ensure_future(hedge.aopen())] = hedge
+        while attempts:
+            done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                attempt = attempts.pop(task)
+                if task.exception() is None:
+                    for loser_task, loser in attempts.items():
+                        # As in `_open_attempt`: cancelling an open running on a thread
+                        # would drop its stream unclosed, so let it finish instead.
+                        loser_task.add_done_callback(
+                            functools.partial(_close_loser, loser)
+                        )
+                    if hedged:
+                        retry_policy.record_hedge(won=attempt is not primary)
+                    return attempt
+                error = task.exception()
+                attempt.close(error)
+    except asyncio.CancelledError:
+        for task, attempt in attempts.items():
+            task.add_done_callback(functools.partial(_close_loser, attempt))
+        raise
+    if hedged:
+        retry_policy.record_hedge(won=False)
+    raise error
+
+
+def _should_retry(error: Exception, yielded: bool, attempt: int, targets: int) -> bool:
+    """
+    Whether to try again after `error`: never once a token has reached the caller,
+    otherwise once per target for failover plus `retry_policy.max_retries` times.
+    """
+    if (
+        yielded
+        or not is_retryable(error)
+        or attempt + 1 >= targets + retry_policy.max_retries
+    ):
+        print("Exception while invoking llama3 endpoint: {}".format(str(error)))
+        return False
+    print(f"Endpoint request failed, retrying (attempt {attempt + 2}): {error}")
+    return True
+
+
+def _retry_delay(attempt: int, targets: int) -> float:
+    """No wait while failing over to fresh targets, then jittered backoff."""
+    retry = attempt + 1 - targets
+    if retry < 0:
+        return 0
+    retry_policy.record_retry()
+    return retry_policy.backoff(retry)
+
+
+def _token_budget(params: dict) -> int:
+    return (params.get("max_tokens") or DEFAULT_MAX_TOKENS) * (params.get("n") or 1)
+
+
+def invoke_endpoint(
+    history: list[dict[str, str]],
+    *,
+    metrics: RequestMetrics | None = None,
+    demux: bool = False,
+    ticket: Ticket | None = None,
+    logprob_capture: LogprobCapture | None = None,
+    tool_step: ToolStep | None = None,
+    **params,
+):
+    """
+    Stream the delta content of the first choice, or `(index, content)` pairs for every
+    choice when `demux` is set, e.g. for `n > 1`.
+
+    The request goes to the target of the admission `ticket` if given, otherwise to
+    the least loaded endpoint serving `params["model"]`. If it fails over or is hedged
+    to another target, the ticket's slot is moved there. Until a
+    token has been yielded, throttling, 5xx and connection errors fail over to the next
+    target and are then retried according to `retry_policy`. Closing the generator
+    closes the response stream, which stops the endpoint generating for it.
+
+    Pass a `LogprobCapture` as `logprob_capture` to keep the logprobs of a request made
+    with `logprobs=True`; such requests bypass the response cache, which stores content
+    only. A `ToolStep` as `tool_step` is given the response's tool calls, see
+    `invoke_with_tools`.
+    """
+    metrics = metrics or RequestMetrics()
+    payload = build_payload(history, **params)
+    encoded = payload_builder.encode(payload)
+    metrics.payload_encode = encoded.seconds
+    cache_key = response_cache.digest(encoded.key_json)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        metrics.cache_hit = True
+        try:
+            yield from _replay(cached, metrics, demux)
+        finally:
+            metrics.finish()
+        return
+    store = response_cache.should_store(cache_key, payload)
+    chunks = []
+    complete = False
+    yielded = False
+    body = encoded.body
+    metrics.payload_bytes = len(body)
+    attempt_no = 0
+    try:
+        while True:
+            targets = router.candidates(
+                params.get("model"), prefer=ticket.target if ticket else None
+            )
+            attempt = None
+            error = None
+            try:
+                attempt = _open_attempt(targets, body)
+                if ticket is not None:
+                    admission.move(ticket, attempt.target)
+                event_stream = metrics.mark_first_byte(attempt.stream())
+                for line in LineIterator(event_stream):
+                    deltas = decode_line(line, logprob_capture, tool_step)
+                    if deltas is _END_OF_STREAM:
+                        break
+                    for index, content in deltas or ():
+                        metrics.observe_token()
+                        if store:
+                            chunks.append((index, content))
+                        if tool_step is not None and index == 0:
+                            tool_step.add_content(content)
+                        if demux:
+                            yielded = True
+                            yield index, content
+                        elif index == 0:
+                            yielded = True
+                            yield content
+                else:
+                    complete = True
+            except Exception as E:
+                error = E
+                if not _should_retry(E, yielded, attempt_no, len(targets)):
+                    raise Exception(E)
+            finally:
+                if attempt is not None:
+                    attempt.close(error)
+            if error is None:
+                break
+            time.sleep(_retry_delay(attempt_no, len(targets)))
+            attempt_no += 1
+    except GeneratorExit:
+        # The consumer closed us mid-stream; the attempt's stream is already closed.
+        metrics.cancel(_token_budget(params))
+        raise
+    finally:
+        metrics.finish()
+    if complete and store:
+        response_cache.put(cache_key, chunks)
+
+
+async def _aiter_in_thread(iterable):
+    """
+    Adapt a blocking iterator to async by pulling each item on a thread of
+    `client_manager.stream_executor`, which is held until the item arrives.
+    """
+    iterator = iter(iterable)
+    while True:
+        item = await client_manager.run_in_stream_thread(next, iterator, _END_OF_STREAM)
+        if item is _END_OF_STREAM:
+            return
+        yield item
+
+
+async def ainvoke_endpoint(
+    history: list[dict[str, str]],
+    *,
+    metrics: RequestMetrics | None = None,
+    demux: bool = False,
+    ticket: Ticket | None = None,
+    logprob_capture: LogprobCapture | None = None,
+    tool_step: ToolStep | None = None,
+    **params,
+):
+    """
+    Async variant of `invoke_endpoint` for use from async Gradio handlers.
+
+    With aiobotocore installed the response stream is read on the event loop, so an open
+    stream costs no worker thread. Without it the blocking boto3 stream is read one event
+    at a time on a thread of `client_manager.stream_executor`, which stays blocked while
+    it waits for the event, so each open stream holds a thread and at most
+    `SAGEMAKER_STREAM_THREADS` streams are read at once.
+    """
+    metrics = metrics or RequestMetrics()
+    payload = build_payload(history, **params)
+    encoded = payload_builder.encode(payload)
+    metrics.payload_encode = encoded.seconds
+    cache_key = response_cache.digest(encoded.key_json)
+    cached = await response_cache.aget(cache_key)
+    if cached is not None:
+        metrics.cache_hit = True
+        try:
+            for item in _replay(cached, metrics, demux):
+                yield item
+        finally:
+            metrics.finish()
+        return
+    store = response_cache.should_store(cache_key, payload)
+    chunks = []
+    complete = False
+    yielded = False
+    body = encoded.body
+    metrics.payload_bytes = len(body)
+    attempt_no = 0
+    try:
+        while True:
+            targets = router.candidates(
+                params.get("model"), prefer=ticket.target if ticket else None
+            )
+            attempt = None
+            error = None
+            try:
+                attempt = await _aopen_attempt(targets, body)
+                if ticket is not None:
+                    admission.move(ticket, attempt.target)
+                event_stream = metrics.amark_first_byte(attempt.astream())
+                async for line in AsyncLineIterator(event_stream):
+                    deltas = decode_line(line, logprob_capture, tool_step)
+                    if deltas is _END_OF_STREAM:
+                        break
+                    for index, content in deltas or ():
+                        metrics.observe_token()
+                        if store:
+                            chunks.append((index, content))
+                        if tool_step is not None and index == 0:
+                            tool_step.add_content(content)
+                        if demux:
+                            yielded = True
+                            yield index, content
+                        elif index == 0:
+                            yielded = True
+                            yield content
+                else:
+                    complete = True
+            except Exception as E:
+                error = E
+                if not _should_retry(E, yielded, attempt_no, len(targets)):
+                    raise Exception(E)
+            finally:
+                if attempt is not None:
+                    attempt.close(error)
+            if error is None:
+                break
+            await asyncio.sleep(_retry_delay(attempt_no, len(targets)))
+            attempt_no += 1
+    except (GeneratorExit, asyncio.CancelledError):
+        metrics.cancel(_token_budget(params))
+        raise
+    finally:
+        metrics.finish()
+    if complete and store:
+        await response_cache.aput(cache_key, chunks)
+
+
+def invoke_with_tools(
+    history: list[dict],
+    metrics: RequestMetrics | None = None,
+    demux: bool = False,
+    max_steps: int = TOOL_MAX_STEPS,
+    logprob_capture: LogprobCapture | None = None,
+    **params,
+):
+    """
+    `invoke_endpoint` for requests with `tools`, which runs the model's tool calls and
+    sends their results back until it answers without one.
+
+    Each call starts as soon as its arguments have streamed, in parallel with the other
+    calls. Yields what `invoke_endpoint` yields, plus the `ToolStep` of a response that
+    called tools once it has ended and again once its results are in. After `max_steps`
+    rounds of calls the model is asked to answer with `tool_choice="none"`. Follow-up
+    requests get their own `RequestMetrics`. `logprob_capture` is reset for each
+    request, so it ends up holding the logprobs of the answer.
+    """
+    history = list(history)
+    step = None
+    try:
+        for number in range(max_steps + 1):
+            step = ToolStep(number)
+            if logprob_capture is not None:
+                logprob_capture.reset()
+            step_params = (
+                params if number < max_steps else {**params, "tool_choice": "none"}
+            )
+            yield from invoke_endpoint(
+                history,
+                metrics=metrics if number == 0 else None,
+                demux=demux,
+                logprob_capture=logprob_capture,
+                tool_step=step,
+                **step_params,
+            )
+            step.close()
+            if not step.calls:
+                return
+            yield step
+            step.wait()
+            yield step
+            history += step.messages()
+    finally:
+        if step is not None:
+            step.cancel()
+
+
+async def ainvoke_with_tools(
+    history: list[dict],
+    metrics: RequestMetrics | None = None,
+    demux: bool = False,
+    max_steps: int = TOOL_MAX_STEPS,
+    logprob_capture: LogprobCapture | None = None,
+    **params,
+):
+    """Async variant of `invoke_with_tools`; results are awaited on a worker thread."""
+    history = list(history)
+    step = None
+    try:
+        for number in range(max_steps + 1):
+            step = ToolStep(number)
+            if logprob_capture is not None:
+                logprob_capture.reset()
+            step_params = (
+                params if number < max_steps else {**params, "tool_choice": "none"}
+            )
+            async with contextlib.aclosing(
+                ainvoke_endpoint(
+                    history,
+                    metrics=metrics if number == 0 else None,
+                    demux=demux,
+                    logprob_capture=logprob_capture,
+                    tool_step=step,
+                    **step_params,
+                )
+            ) as chunks:
+                async for item in chunks:
+                    yield item
+            step.close()
+            if not step.calls:
+                return
+            yield step
+            await asyncio.to_thread(step.wait)
+            yield step
+            history += step.messages()
+    finally:
+        if step is not None:
+            step.cancel()
+
+
+def prewarm_cache(histories: list[list[dict[str, str]]], **params):
+    """Run each history through the endpoint once so later identical requests replay."""
+    for history in histories:
+        response_cache.pin(response_cache.key(build_payload(history, **params)))
+        for _ in invoke_endpoint(history, **params):
+            pass
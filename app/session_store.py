@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+SESSION_DB = os.environ.get("SESSION_DB", "sessions.sqlite3")
+
+
+class SessionStore:
+    """
+    Chat histories kept on the server, keyed by session ID.
+
+    Each turn appends only its new messages to a SQLite table, so sessions survive a
+    restart without rewriting the whole conversation. The most recently used sessions
+    are also kept in memory so a turn does not read its history back from disk.
+    """
+
+    def __init__(self, path: str = SESSION_DB, max_sessions: int = 256):
+        self.path = path
+        self.max_sessions = max_sessions
+        self._hot = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    PRIMARY KEY (session_id, seq)
+                )
+                """)
+        self.hot_hits = 0
+        self.disk_loads = 0
+
+    def _history(self, session_id: str) -> list[dict]:
+        history = self._hot.get(session_id)
+        if history is not None:
+            self._hot.move_to_end(session_id)
+            self.hot_hits += 1
+            return history
+        rows = self._db.execute(
+            "SELECT message FROM messages WHERE session_id = ? ORDER BY seq",
+            (session_id,),
+        )
+        self.disk_loads += 1
+        return self._remember(session_id, [json.loads(message) for (message,) in rows])
+
+    def _remember(self, session_id: str, history: list[dict]) -> list[dict]:
+        self._hot[session_id] = history
+        self._hot.move_to_end(session_id)
+        while len(self._hot) > self.max_sessions:
+            self._hot.popitem(last=False)
+        return history
+
+    def load(self, session_id: str) -> list[dict]:
+        with self._lock:
+            return list(self._history(session_id))
+
+    def append(
+        self, session_id: str, messages: list[dict], at: int | None = None
+    ) -> bool:
+        """
+        Append `messages` to the session. With `at`, only if the history still has
+        that many messages, so a reply finishing after the chat was cleared or
+        replaced is dropped rather than appended to the new conversation.
+        """
+        with self._lock:
+            history = self._history(session_id)
+            if not messages or (at is not None and at != len(history)):
+                return False
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO messages (session_id, seq, message) VALUES (?, ?, ?)",
+                    [
+                        (session_id, seq, json.dumps(message))
+                        for seq, message in enumerate(messages, start=len(history))
+                    ],
+                )
+            history.extend(messages)
+            return True
+
+    def replace(self, session_id: str, messages: list[dict]):
+        """Overwrite the whole history, e.g. for a new system prompt or pasted JSON."""
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "DELETE FROM messages WHERE session_id = ?", (session_id,)
+                )
+                self._db.executemany(
+                    "INSERT INTO messages (session_id, seq, message) VALUES (?, ?, ?)",
+                    [
+                        (session_id, seq, json.dumps(message))
+                        for seq, message in enumerate(messages)
+                    ],
+                )
+            self._remember(session_id, list(messages))
+
+    def stats(self) -> dict:
+        with self._lock:
+            (sessions,) = self._db.execute(
+                "SELECT COUNT(DISTINCT session_id) FROM messages"
+            ).fetchone()
+            return {
+                "path": self.path,
+                "sessions": sessions,
+                "hot_sessions": len(self._hot),
+                "hot_hits": self.hot_hits,
+                "disk_loads": self.disk_loads,
+            }
+
+
+session_store = SessionStore(
+    path=SESSION_DB,
+    max_sessions=int(os.environ.get("SESSION_HOT_ENTRIES", 256)),
+)
@@ -0,0 +1,138 @@
+"""
+Startup profiling, warm-up and readiness for the demo apps.
+
+The apps import this module first, time their imports and UI construction with
+`profile.phase()`, and start the warm-up on a background thread before importing
+gradio, so building the SageMaker clients (and the optional probe request, which
+also opens their TLS connections) overlaps with the slowest import. The metrics
+server answers `/ready` with 200 only once the warm-up has finished and the UI is
+listening.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+STARTUP_PROBE = os.environ.get("STARTUP_PROBE", "").lower() in ("1", "true", "yes")
+
+
+class StartupProfile:
+    """Wall-clock time of each named startup phase, relative to this module's import."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases.append(
+                    {
+                        "phase": name,
+                        "thread": threading.current_thread().name,
+                        "start_ms": round((start - self.start) * 1000, 1),
+                        "duration_ms": round((end - start) * 1000, 1),
+                    }
+                )
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "total_ms": round((time.perf_counter() - self.start) * 1000, 1),
+                "phases": sorted(self.phases, key=lambda phase: phase["start_ms"]),
+            }
+
+    def print_report(self):
+        print("startup_profile " + json.dumps(self.report()))
+
+
+class Readiness:
+    """Ready once every required component has been marked."""
+
+    def __init__(self, *required: str):
+        self.required = set(required)
+        self.done = set()
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def mark(self, component: str, error: str | None = None):
+        with self._lock:
+            self.done.add(component)
+            if error:
+                self.errors[component] = error
+
+    @property
+    def ready(self) -> bool:
+        with self._lock:
+            return self.required <= self.done
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.required <= self.done,
+                "pending": sorted(self.required - self.done),
+                "errors": dict(self.errors),
+            }
+
+
+profile = StartupProfile()
+readiness = Readiness("warm_up", "ui")
+
+
+def warm_up(probe: bool = STARTUP_PROBE):
+    """Build the endpoint clients and, with `probe`, send each model a 1-token request."""
+    errors = []
+    try:
+        from endpoint_router import router
+        from sagemaker_utils import client_manager, invoke_endpoint, load_aiobotocore
+
+        with profile.phase("warm_up.clients"):
+            client_manager.warm_up(router.client_keys())
+            load_aiobotocore()
+        if probe:
+            with profile.phase("warm_up.probe"):
+                for model in router.models():
+                    try:
+                        for _ in invoke_endpoint(
+                            [{"role": "user", "content": "ping"}],
+                            model=model,
+                            max_tokens=1,
+                        ):
+                            pass
+                    except Exception as e:
+                        errors.append(f"{model}: {e}")
+    except Exception as e:
+        errors.append(str(e))
+    for error in errors:
+        print(f"Startup warm-up failed: {error}")
+    # Probe failures are reported but do not hold back readiness; the router fails
+    # over and retries on real requests.
+    readiness.mark("warm_up", "; ".join(errors) or None)
+
+
+def start_warm_up() -> threading.Thread:
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def launch(demo, **kwargs):
+    """
+    `demo.launch(**kwargs)` that marks the UI ready once the server is listening and
+    prints the startup profile, then blocks the main thread as `launch()` would.
+    """
+    with profile.phase("launch"):
+        demo.launch(prevent_thread_lock=True, **kwargs)
+    readiness.mark("ui")
+    profile.print_report()
+    # Under `gradio` reload mode, launch() returns without starting a new server.
+    if demo.is_running:
+        demo.block_thread()
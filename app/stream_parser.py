@@ -0,0 +1,318 @@
+import json
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+THINK_START = "<think>"
+THINK_END = "</think>"
+
+THINKING_DELTA = "thinking_delta"
+ANSWER_DELTA = "answer_delta"
+THINKING_DONE = "thinking_done"
+
+
+@dataclass
+class StreamEvent:
+    type: str
+    text: str = ""
+
+
+class TextBuilder:
+    """Accumulates text deltas in a list and joins them only when the text is read."""
+
+    def __init__(self):
+        self.parts = []
+        self._text = ""
+        self._joined = 0
+
+    def append(self, text: str):
+        if text:
+            self.parts.append(text)
+
+    def __str__(self) -> str:
+        if self._joined != len(self.parts):
+            self._text = "".join(self.parts)
+            self.parts = [self._text]
+            self._joined = 1
+        return self._text
+
+    def __len__(self) -> int:
+        return len(str(self))
+
+
+def _partial_tag_suffix(text: str, tag: str) -> int:
+    """Length of the longest suffix of `text` that is a proper prefix of `tag`."""
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ThinkStreamParser:
+    """
+    Incremental parser for `<think>...</think>` delimited reasoning streams.
+
+    Chunks are fed as they arrive from the endpoint and turned into `thinking_delta`
+    and `answer_delta` events. Text outside a think block is answer text. Tags may be
+    split across chunks (`"</thi"` + `"nk>"`), so the parser holds back only the tail of
+    a chunk that could still grow into the tag it is waiting for. Each chunk is scanned
+    once, so the cost per chunk is proportional to the chunk, not to the response.
+    """
+
+    def __init__(self):
+        self.in_think = False
+        self.thinking_done = False
+        self.pending = ""
+        self._thinking = TextBuilder()
+        self._answer = TextBuilder()
+
+    @property
+    def thinking(self) -> str:
+        return str(self._thinking)
+
+    @property
+    def answer(self) -> str:
+        return str(self._answer)
+
+    def _emit(self, text: str, events: list[StreamEvent]):
+        if not text:
+            return
+        if self.in_think:
+            self._thinking.append(text)
+            events.append(StreamEvent(THINKING_DELTA, text))
+        else:
+            self._answer.append(text)
+            events.append(StreamEvent(ANSWER_DELTA, text))
+
+    def feed(self, chunk: str) -> list[StreamEvent]:
+        events = []
+        text = self.pending + chunk
+        self.pending = ""
+        start = 0
+        while True:
+            tag = THINK_END if self.in_think else THINK_START
+            found = text.find(tag, start)
+            if found == -1:
+                break
+            self._emit(text[start:found], events)
+            if self.in_think:
+                self.thinking_done = True
+                events.append(StreamEvent(THINKING_DONE))
+            self.in_think = not self.in_think
+            start = found + len(tag)
+
+        hold = _partial_tag_suffix(text[start:], tag)
+        self._emit(text[start : len(text) - hold], events)
+        self.pending = text[len(text) - hold :]
+        return events
+
+    def close(self) -> list[StreamEvent]:
+        """Flush held-back text at the end of the stream."""
+        events = []
+        self._emit(self.pending, events)
+        self.pending = ""
+        return events
+
+
+_STRUCTURAL = re.compile(r'[\[\]{}",]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class JsonStreamParser:
+    """
+    Incremental parser for a JSON answer that returns its records as soon as they close.
+
+    A record is either an object directly inside the first array reached, such as each
+    `{"index": 3, "label": ...}` of a `{"mappings": [...]}` answer, returned as
+    `(position, object)`, or a scalar member of the top-level object, such as
+    `"3": "Patient DOB"`, returned as `(key, value)`. Text before the JSON starts,
+    like a code fence, is skipped.
+
+    Structural characters are found with a regex from where the last chunk stopped, and
+    each record is decoded once when it closes, so the total cost is linear in the size
+    of the answer. Only the text of the record still open is kept.
+    """
+
+    def __init__(self):
+        self.complete = False
+        self._text = ""
+        self._pos = 0
+        self._in_string = False
+        self._stack = []
+        self._item_depth = None
+        self._items = 0
+        self._member_start = None
+        self._member_nested = False
+
+    def feed(self, chunk: str) -> list[tuple]:
+        records = []
+        if self.complete:
+            return records
+        self._text += chunk
+        text = self._text
+        pos = self._pos
+        stack = self._stack
+        while pos < len(text):
+            if self._in_string:
+                match = _STRING_SPECIAL.search(text, pos)
+                if match is None:
+                    pos = len(text)
+                    break
+                pos = match.end()
+                if match.group() == "\\":
+                    # Skip the escaped character, even if it has not arrived yet.
+                    pos += 1
+                else:
+                    self._in_string = False
+                continue
+            match = _STRUCTURAL.search(text, pos)
+            if match is None:
+                pos = len(text)
+                break
+            char, at = match.group(), match.start()
+            pos = match.end()
+            if not stack and char not in "[{":
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                if len(stack) == 1 and stack[0][0] == "{":
+                    self._member_nested = True
+                stack.append((char, at))
+                if len(stack) == 1 and char == "{":
+                    self._member_start = at + 1
+                elif char == "{" and self._item_depth is None and stack[-2][0] == "[":
+                    self._item_depth = len(stack)
+            elif char in "]}":
+                opener, start = stack.pop()
+                if char == "}" and len(stack) + 1 == self._item_depth:
+                    try:
+                        records.append((self._items, json.loads(text[start : at + 1])))
+                    except json.JSONDecodeError:
+                        pass
+                    self._items += 1
+                elif not stack and opener == "{":
+                    self._end_member(text, at, records)
+                if not stack:
+                    self.complete = True
+                    break
+            elif char == "," and len(stack) == 1 and stack[0][0] == "{":
+                self._end_member(text, at, records)
+        self._pos = pos
+        self._trim()
+        return records
+
+    def feed_events(self, events: list[StreamEvent]) -> list[tuple]:
+        """Feed the answer deltas of `ThinkStreamParser` events."""
+        records = []
+        for event in events:
+            if event.type == ANSWER_DELTA:
+                records.extend(self.feed(event.text))
+        return records
+
+    def _end_member(self, text: str, end: int, records: list):
+        member = text[self._member_start : end]
+        if not self._member_nested and member.strip():
+            try:
+                records.extend(json.loads("{" + member + "}").items())
+            except json.JSONDecodeError:
+                pass
+        self._member_start = end + 1
+        self._member_nested = False
+
+    def _trim(self):
+        """Drop text that no open record can still need."""
+        keep = self._pos
+        if self._item_depth is not None and len(self._stack) >= self._item_depth:
+            keep = self._stack[self._item_depth - 1][1]
+        elif self._member_start is not None and len(self._stack) == 1:
+            keep = min(keep, self._member_start)
+        # Trimming at half the buffer keeps the copying amortized linear.
+        if keep < 256 or keep < len(self._text) // 2:
+            return
+        self._text = self._text[keep:]
+        self._pos -= keep
+        self._stack = [(char, start - keep) for char, start in self._stack]
+        if self._member_start is not None:
+            self._member_start -= keep
+
+
+class UpdateCounters:
+    """Process-wide count of stream chunks received versus UI updates sent."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.chunks_received = 0
+        self.updates_sent = 0
+
+    def add(self, chunks_received: int, updates_sent: int):
+        with self._lock:
+            self.chunks_received += chunks_received
+            self.updates_sent += updates_sent
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chunks_received": self.chunks_received,
+                "updates_sent": self.updates_sent,
+                "chunks_per_update": (
+                    self.chunks_received / self.updates_sent if self.updates_sent else 0
+                ),
+            }
+
+
+update_counters = UpdateCounters()
+
+
+class FlushPolicy:
+    """
+    Decides which stream chunks are worth a UI update.
+
+    Every yield from a Gradio handler re-serializes the whole chat, so chunks are
+    coalesced and the UI is updated at most every `interval_ms` milliseconds or every
+    `every_tokens` chunks, whichever comes first, and always when thinking ends. With
+    both set to 0 every chunk is sent, which is plain token-level streaming.
+
+    Create one policy per request and call `finish()` when the stream ends.
+    """
+
+    def __init__(
+        self,
+        interval_ms: float = 50,
+        every_tokens: int = 0,
+        on_transition: bool = True,
+    ):
+        self.interval = interval_ms / 1000
+        self.every_tokens = every_tokens
+        self.on_transition = on_transition
+        self.chunks_received = 0
+        self.updates_sent = 0
+        self._pending = 0
+        self._last_flush = float("-inf")
+
+    def should_flush(self, events: list[StreamEvent]) -> bool:
+        self.chunks_received += 1
+        self._pending += 1
+        now = time.monotonic()
+        if not self.interval and not self.every_tokens:
+            flush = True
+        else:
+            flush = (
+                (self.every_tokens and self._pending >= self.every_tokens)
+                or (self.interval and now - self._last_flush >= self.interval)
+                or (
+                    self.on_transition
+                    and any(event.type == THINKING_DONE for event in events)
+                )
+            )
+        if flush:
+            self.updates_sent += 1
+            self._pending = 0
+            self._last_flush = now
+        return bool(flush)
+
+    def finish(self):
+        """Count the final update and add this request to the process-wide counters."""
+        self.updates_sent += 1
+        update_counters.add(self.chunks_received, self.updates_sent)
@@ -0,0 +1,443 @@
+"""
+Python tools the model can call, and the engine that runs its calls while it streams.
+
+Tools are registered with the `tool` decorator and offered to the model as OpenAI
+`tools` specs. `ToolStep` follows one response's streamed `tool_calls` deltas and
+submits each call to a bounded pool as soon as its arguments are complete JSON, so
+several calls run in parallel with each other and with the rest of the stream.
+`invoke_with_tools` in `sagemaker_utils` sends the results back in a follow-up request
+until the model answers without calling a tool.
+
+More tools can be registered from the modules listed in `TOOL_MODULES`.
+"""
+
+import ast
+import datetime
+import importlib
+import json
+import math
+import operator
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Callable
+
+from stream_parser import JsonStreamParser
+
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", 10))
+TOOL_MAX_WORKERS = int(os.environ.get("TOOL_MAX_WORKERS", 8))
+TOOL_MAX_STEPS = int(os.environ.get("TOOL_MAX_STEPS", 4))
+TOOL_MESSAGE_TITLE = "🛠️ Tool"
+
+
+@dataclass
+class Tool:
+    name: str
+    function: Callable
+    description: str
+    parameters: dict
+    timeout: float = TOOL_TIMEOUT
+    # CPU-bound tools run in a process pool; they must be module-level functions.
+    process: bool = False
+
+    def spec(self) -> dict:
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": self.parameters,
+            },
+        }
+
+
+class ToolRegistry:
+    def __init__(self):
+        self.tools = {}
+
+    def register(
+        self,
+        function: Callable | None = None,
+        *,
+        name: str | None = None,
+        description: str | None = None,
+        parameters: dict | None = None,
+        timeout: float = TOOL_TIMEOUT,
+        process: bool = False,
+    ):
+        """Register `function` as a tool, as a bare decorator or with options."""
+
+        def decorator(function: Callable) -> Callable:
+            tool = Tool(
+                name=name or function.__name__,
+                function=function,
+                description=description or (function.__doc__ or "").strip(),
+                parameters=parameters or {"type": "object", "properties": {}},
+                timeout=timeout,
+                process=process,
+            )
+            self.tools[tool.name] = tool
+            return function
+
+        return decorator(function) if function is not None else decorator
+
+    def names(self) -> list[str]:
+        return list(self.tools)
+
+    def specs(self, names: list[str] | None = None) -> list[dict]:
+        return [
+            tool.spec()
+            for tool in self.tools.values()
+            if names is None or tool.name in names
+        ]
+
+
+tool_registry = ToolRegistry()
+tool = tool_registry.register
+
+
+def _run_tool(function: Callable, arguments: dict) -> tuple[float, float, str]:
+    """Run in the pool: the tool's start and end time and its result as text."""
+    started = time.time()
+    result = function(**arguments)
+    if not isinstance(result, str):
+        result = json.dumps(result, default=str)
+    return started, time.time(), result
+
+
+class ToolExecutor:
+    """
+    Bounded pools for tool calls: threads for I/O-bound tools and, created on first
+    use, processes for tools registered with `process=True`. A call that times out is
+    reported as such, but a call that has already started cannot be stopped and keeps
+    its worker until it returns.
+    """
+
+    def __init__(self, max_workers: int = TOOL_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._threads = ThreadPoolExecutor(max_workers, thread_name_prefix="tool")
+        self._processes = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def submit(self, tool: Tool, arguments: dict) -> Future:
+        with self._lock:
+            self.submitted += 1
+            if tool.process and self._processes is None:
+                self._processes = ProcessPoolExecutor(self.max_workers)
+        pool = self._processes if tool.process else self._threads
+        return pool.submit(_run_tool, tool.function, arguments)
+
+    def record(self, status: str):
+        with self._lock:
+            if status == "timeout":
+                self.timeouts += 1
+            elif status == "error":
+                self.errors += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "tools": tool_registry.names(),
+                "submitted": self.submitted,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+            }
+
+
+tool_executor = ToolExecutor()
+
+
+@dataclass
+class ToolCall:
+    index: int
+    id: str = ""
+    name: str = ""
+    arguments: str = ""
+    status: str = "streaming"
+    result: str | None = None
+    # Wall-clock times; the durations below are what the timing breakdown reports.
+    ready_at: float | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+    deadline: float | None = None
+    future: Future | None = None
+    _parser: JsonStreamParser = field(default_factory=JsonStreamParser, repr=False)
+
+    def feed(self, arguments: str) -> bool:
+        """Add a fragment of the arguments; True once they are a complete object."""
+        self.arguments += arguments
+        self._parser.feed(arguments)
+        return self._parser.complete
+
+    def finish(self, status: str, result: str):
+        self.status = status
+        self.result = result
+        self.finished_at = self.finished_at or time.time()
+
+    def timings(self, start: float) -> dict:
+        def ms(t, since):
+            return None if t is None or since is None else round((t - since) * 1000, 1)
+
+        return {
+            "name": self.name,
+            "status": self.status,
+            "ready_ms": ms(self.ready_at, start),
+            "queued_ms": ms(self.started_at, self.ready_at),
+            "run_ms": ms(self.finished_at, self.started_at or self.finished_at),
+        }
+
+
+class ToolStep:
+    """
+    The tool calls of one streamed response, for its first choice.
+
+    `decode_line` passes each chunk's choice to `observe`, which accumulates the
+    `tool_calls` deltas per call index and submits a call to the executor the moment
+    its arguments close, without waiting for the rest of the response. Most content
+    lines never reach `observe`, since `decode_line` only decodes lines with tool calls
+    in full, so `invoke_endpoint` adds the content it yields with `add_content`.
+    `wait()` collects the results, each within its tool's timeout, and `messages()`
+    returns the assistant and tool messages to send back to the model.
+    """
+
+    def __init__(
+        self,
+        number: int = 0,
+        registry: ToolRegistry = tool_registry,
+        executor: ToolExecutor = tool_executor,
+    ):
+        self.number = number
+        self.registry = registry
+        self.executor = executor
+        self.calls = {}
+        self.content = ""
+        self.start = time.time()
+        self.stream_end = None
+        self.wait_end = None
+
+    def observe(self, choice: dict):
+        delta = choice.get("delta") or {}
+        tool_calls = delta.get("tool_calls") or ()
+        # Some servers send a single call object rather than a list.
+        if isinstance(tool_calls, dict):
+            tool_calls = [tool_calls]
+        for delta_call in tool_calls:
+            index = delta_call.get("index", 0)
+            call = self.calls.get(index)
+            if call is None:
+                call = self.calls[index] = ToolCall(index)
+            call.id = call.id or delta_call.get("id") or ""
+            function = delta_call.get("function") or {}
+            call.name = call.name or function.get("name") or ""
+            if (
+                function.get("arguments")
+                and call.feed(function["arguments"])
+                and call.status == "streaming"
+            ):
+                self._dispatch(call)
+
+    def add_content(self, content: str):
+        self.content += content
+
+    def close(self):
+        """The stream has ended: run any call whose arguments never parsed as complete."""
+        self.stream_end = time.time()
+        for call in self.calls.values():
+            if call.status == "streaming":
+                self._dispatch(call)
+
+    def _dispatch(self, call: ToolCall):
+        call.ready_at = time.time()
+        call.status = "running"
+        call.id = call.id or f"call_{self.number}_{call.index}"
+        try:
+            arguments = json.loads(call.arguments or "{}")
+        except json.JSONDecodeError as e:
+            call.finish("error", f"Invalid arguments: {e}")
+            return
+        if not isinstance(arguments, dict):
+            call.finish("error", "Invalid arguments: expected a JSON object")
+            return
+        # Older TGI versions put the name inside the arguments as `function._name`.
+        if not call.name and isinstance(arguments.get("function"), dict):
+            arguments = dict(arguments["function"])
+            call.name = arguments.pop("_name", "")
+        tool = self.registry.tools.get(call.name)
+        if tool is None:
+            call.finish("error", f"Unknown tool: {call.name}")
+            return
+        call.deadline = call.ready_at + tool.timeout
+        call.future = self.executor.submit(tool, arguments)
+
+    def wait(self):
+        """Collect every call's result; calls past their deadline are reported as timed out."""
+        for call in self.calls.values():
+            if call.future is None:
+                # Never submitted: bad arguments or an unknown tool.
+                self.executor.record(call.status)
+                continue
+            try:
+                remaining = max(call.deadline - time.time(), 0)
+                call.started_at, call.finished_at, result = call.future.result(
+                    timeout=remaining
+                )
+                call.finish("ok", result)
+            except FutureTimeoutError:
+                call.future.cancel()
+                call.finish(
+                    "timeout",
+                    f"Timed out after {call.deadline - call.ready_at:g} s",
+                )
+            except Exception as e:
+                call.finish("error", f"{type(e).__name__}: {e}")
+            self.executor.record(call.status)
+        self.wait_end = time.time()
+
+    def cancel(self):
+        for call in self.calls.values():
+            if call.future is not None:
+                call.future.cancel()
+
+    @property
+    def done(self) -> bool:
+        return self.wait_end is not None
+
+    def messages(self) -> list[dict]:
+        calls = sorted(self.calls.values(), key=lambda call: call.index)
+        return [
+            {
+                "role": "assistant",
+                "content": self.content or None,
+                "tool_calls": [
+                    {
+                        "id": call.id,
+                        "type": "function",
+                        "function": {"name": call.name, "arguments": call.arguments},
+                    }
+                    for call in calls
+                ],
+            }
+        ] + [
+            {"role": "tool", "tool_call_id": call.id, "content": call.result or ""}
+            for call in calls
+        ]
+
+    def summary(self) -> dict:
+        """Timing breakdown: how long the calls ran and how long the turn waited on them."""
+        calls = [call.timings(self.start) for call in self.calls.values()]
+        run_ms = [call["run_ms"] or 0 for call in calls]
+        return {
+            "step": self.number,
+            "calls": calls,
+            "stream_ms": (
+                round((self.stream_end - self.start) * 1000, 1)
+                if self.stream_end
+                else None
+            ),
+            # Time between the end of the stream and the last result: what the
+            # overlap with streaming and the parallel calls did not hide.
+            "wait_ms": (
+                round((self.wait_end - self.stream_end) * 1000, 1)
+                if self.done and self.stream_end
+                else None
+            ),
+            "serial_run_ms": round(sum(run_ms), 1),
+        }
+
+
+def is_tool_message(message: dict) -> bool:
+    """A tool call as displayed in the chat, which is not sent back to the model."""
+    metadata = message.get("metadata") or {}
+    return (metadata.get("title") or "").startswith(TOOL_MESSAGE_TITLE)
+
+
+_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+# Operands and results are kept within 10**100, so that no expression, however the
+# powers are nested, makes a tool worker compute with huge integers.
+_MAX_DIGITS = 100
+
+
+def _bounded(value):
+    if abs(value) > 10**_MAX_DIGITS:
+        raise ValueError("Number too large")
+    return value
+
+
+def _evaluate(node):
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return _bounded(node.value)
+    if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+        left, right = _evaluate(node.left), _evaluate(node.right)
+        # Check a power's size from its logarithm before computing it.
+        if (
+            isinstance(node.op, ast.Pow)
+            and left != 0
+            and abs(right) * abs(math.log10(abs(left))) > _MAX_DIGITS
+        ):
+            raise ValueError("Number too large")
+        return _bounded(_OPERATORS[type(node.op)](left, right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _OPERATORS:
+        return _OPERATORS[type(node.op)](_evaluate(node.operand))
+    raise ValueError(f"Unsupported expression: {ast.dump(node)}")
+
+
+@tool(
+    parameters={
+        "type": "object",
+        "properties": {
+            "expression": {
+                "type": "string",
+                "description": "Arithmetic expression, e.g. (3 + 4) * 2 / 7",
+            }
+        },
+        "required": ["expression"],
+    }
+)
+def calculator(expression: str):
+    """Evaluate an arithmetic expression with + - * / // % and **."""
+    return _evaluate(ast.parse(expression, mode="eval"))
+
+
+@tool(
+    parameters={
+        "type": "object",
+        "properties": {
+            "utc_offset_hours": {
+                "type": "number",
+                "description": "Offset from UTC in hours, 0 for UTC",
+            }
+        },
+    }
+)
+def current_time(utc_offset_hours: float = 0):
+    """The current date and time at the given UTC offset, in ISO 8601."""
+    zone = datetime.timezone(datetime.timedelta(hours=utc_offset_hours))
+    return datetime.datetime.now(zone).isoformat(timespec="seconds")
+
+
+for module in filter(None, os.environ.get("TOOL_MODULES", "").split(",")):
+    try:
+        importlib.import_module(module.strip())
+    except ImportError as e:
+        print(f"Tool module {module} not loaded: {e}")
@@ -0,0 +1,92 @@
+import json
+import random
+
+from stream_parser import JsonStreamParser
+
+STRINGS = ["Patient DOB", 'say "hi"', "a\\b", "{[,]}", "é 🤔", "line\nbreak", ""]
+
+
+def random_value(rng: random.Random, depth: int = 0):
+    kind = rng.randrange(6 if depth < 2 else 4)
+    if kind == 0:
+        return rng.choice(STRINGS)
+    if kind == 1:
+        return rng.randint(-5, 500)
+    if kind == 2:
+        return rng.choice([None, True, False, 1.5])
+    if kind == 3:
+        return rng.choice(STRINGS) + str(rng.randint(0, 9))
+    if kind == 4:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+    return {
+        rng.choice(STRINGS): random_value(rng, depth + 1)
+        for _ in range(rng.randint(0, 3))
+    }
+
+
+def random_dumps(value, rng: random.Random) -> str:
+    return json.dumps(
+        value,
+        indent=rng.choice([None, 2]),
+        ensure_ascii=rng.random() < 0.5,
+    )
+
+
+def feed_in_chunks(parser: JsonStreamParser, text: str, rng: random.Random) -> list:
+    records = []
+    start = 0
+    while start < len(text):
+        end = start + rng.randint(1, 12)
+        records += parser.feed(text[start:end])
+        start = end
+    return records
+
+
+def test_array_records_match_whole_decode():
+    rng = random.Random(0)
+    for _ in range(300):
+        mappings = [
+            {"index": i, "label": random_value(rng), "extra": random_value(rng)}
+            for i in range(rng.randint(0, 8))
+        ]
+        document = {"mappings": mappings}
+        text = rng.choice(["", "```json\n", "Here you go: "]) + random_dumps(
+            document, rng
+        )
+        parser = JsonStreamParser()
+        assert feed_in_chunks(parser, text + "\n```", rng) == list(enumerate(mappings))
+        assert parser.complete
+
+
+def test_object_members_match_whole_decode():
+    rng = random.Random(1)
+    for _ in range(300):
+        # No arrays: objects in the first array would be returned as array records.
+        document = {
+            str(i): rng.choice([random_value(rng, depth=2), {"nested": i}])
+            for i in range(rng.randint(0, 8))
+        }
+        parser = JsonStreamParser()
+        records = feed_in_chunks(parser, random_dumps(document, rng), rng)
+        # Nested members are not records of their own.
+        expected = [
+            (key, value)
+            for key, value in document.items()
+            if not isinstance(value, dict)
+        ]
+        assert records == expected
+        assert parser.complete
+
+
+def test_buffer_only_keeps_the_open_record():
+    parser = JsonStreamParser()
+    parser.feed('{"mappings": [')
+    for i in range(2000):
+        parser.feed(json.dumps({"index": i, "label": "x" * 50}) + ", ")
+    assert len(parser._text) < 1000
+
+
+def test_text_after_the_document_is_ignored():
+    parser = JsonStreamParser()
+    assert parser.feed('{"a": 1} {"b": 2}') == [("a", 1)]
+    assert parser.feed('{"c": 3}') == []
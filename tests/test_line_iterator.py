@@ -0,0 +1,102 @@
+import asyncio
+import json
+import random
+
+from sagemaker_utils import (
+    AsyncLineIterator,
+    LineIterator,
+    _fast_delta_content,
+    decode_line,
+)
+
+TEXTS = ["plain", " é ü", '"quoted"', "back\\slash", "tab\t", "new\nline", "🤔", ""]
+
+
+def random_lines(rng: random.Random, count: int) -> list[bytes]:
+    lines = []
+    for _ in range(count):
+        choice = {
+            "index": rng.randint(0, 3),
+            "delta": {"role": "assistant", "content": rng.choice(TEXTS)},
+        }
+        data = {"id": "chatcmpl", "choices": [choice]}
+        separators = rng.choice([None, (",", ":")])
+        lines.append(b"data: " + json.dumps(data, separators=separators).encode())
+        if rng.random() < 0.2:
+            lines.append(b"")
+    return lines
+
+
+def split_events(stream: bytes, rng: random.Random) -> list[dict]:
+    """Cut the stream into `PayloadPart` events at random byte offsets."""
+    events = []
+    start = 0
+    while start < len(stream):
+        end = start + rng.randint(1, 64)
+        events.append({"PayloadPart": {"Bytes": stream[start:end]}})
+        start = end
+    return events
+
+
+def test_lines_survive_any_split():
+    rng = random.Random(0)
+    for _ in range(200):
+        lines = random_lines(rng, rng.randint(0, 30))
+        stream = b"\n".join(lines) + rng.choice([b"\n", b""])
+        expected = stream.split(b"\n")
+        if stream.endswith(b"\n") or not stream:
+            expected.pop()
+        assert list(LineIterator(split_events(stream, rng))) == expected
+
+
+def test_async_lines_match_sync():
+    async def events(items):
+        for item in items:
+            yield item
+
+    async def collect(items):
+        return [line async for line in AsyncLineIterator(events(items))]
+
+    rng = random.Random(1)
+    stream = b"\n".join(random_lines(rng, 50)) + b"\ntrailing"
+    items = split_events(stream, rng)
+    assert asyncio.run(collect(items)) == list(LineIterator(items))
+
+
+def test_buffer_holds_at_most_one_partial_line():
+    line = b"data: " + b"x" * 100 + b"\n"
+    iterator = LineIterator({"PayloadPart": {"Bytes": line}} for _ in range(1000))
+    for _ in iterator:
+        assert len(iterator.buffer) <= 2 * len(line)
+
+
+def test_fast_path_matches_full_decode():
+    rng = random.Random(2)
+    fast_lines = 0
+    for line in random_lines(rng, 500):
+        if not line:
+            continue
+        data = json.loads(line[line.find(b"{") :])
+        expected = [
+            (choice["index"], choice["delta"]["content"]) for choice in data["choices"]
+        ]
+        fast = _fast_delta_content(line)
+        if fast is not None:
+            fast_lines += 1
+            assert fast == expected
+        assert decode_line(line) == expected
+    assert fast_lines
+
+
+def test_fast_path_defers_lines_it_cannot_handle():
+    lines = [
+        b'data: {"choices":[{"index":0,"delta":{"content":null}}]}',
+        (
+            b'data: {"choices":[{"index":0,"delta":{"content":"a"}},'
+            b'{"index":1,"delta":{"content":"b"}}]}'
+        ),
+        b'data: {"choices":[{"index":0,"delta":{"tool_calls":[]}}]}',
+    ]
+    for line in lines:
+        assert _fast_delta_content(line) is None
+    assert decode_line(lines[1]) == [(0, "a"), (1, "b")]
@@ -0,0 +1,57 @@
+import json
+import random
+
+from payload_builder import PayloadBuilder
+from response_cache import ResponseCache
+
+TEXTS = ["You are a helpful assistant.", "é 🤔  ", 'say "hi"\n', "x" * 300, ""]
+PARAMS = {
+    "model": ["r1", "llama"],
+    "max_tokens": [None, 1, 1024],
+    "temperature": [None, 0, 0.7],
+    "stop": [None, ["</answer>", "\n\n"]],
+    "tools": [None, [{"type": "function", "function": {"name": "f", "b": 1, "a": 2}}]],
+    "n": [None, 2],
+}
+
+
+def random_message(rng: random.Random) -> dict:
+    role = rng.choice(["system", "user", "assistant", "tool"])
+    message = {"role": role, "content": rng.choice(TEXTS) + str(rng.randint(0, 3))}
+    if role == "assistant" and rng.random() < 0.2:
+        message["content"] = None
+        message["tool_calls"] = [
+            {"id": "c1", "type": "function", "function": {"name": "f"}}
+        ]
+    elif role == "tool":
+        message["tool_call_id"] = "c1"
+    return message
+
+
+def random_payload(rng: random.Random) -> dict:
+    params = {key: rng.choice(values) for key, values in PARAMS.items()}
+    params = dict(rng.sample(list(params.items()), rng.randint(0, len(params))))
+    messages = [random_message(rng) for _ in range(rng.randint(0, 6))]
+    return {"messages": messages, **params, "stream": rng.choice([True, None])}
+
+
+def test_encoding_matches_json_dumps_and_cache_key():
+    rng = random.Random(0)
+    # A small cache, so the fuzzing also runs through evictions.
+    builder = PayloadBuilder(max_bytes=4096)
+    for _ in range(500):
+        payload = random_payload(rng)
+        if rng.random() < 0.1:
+            # Payloads of other shapes are encoded directly.
+            payload = dict(reversed(payload.items()))
+        encoded = builder.encode(payload)
+        assert encoded.body == json.dumps(payload)
+        assert ResponseCache.digest(encoded.key_json) == ResponseCache.key(payload)
+    assert builder.messages_reused
+
+
+def test_cache_stays_within_max_bytes():
+    builder = PayloadBuilder(max_bytes=1000)
+    for i in range(100):
+        builder.encode({"messages": [{"role": "user", "content": f"{i}" * 50}]})
+        assert builder.stats()["cached_bytes"] <= 1000
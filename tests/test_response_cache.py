@@ -0,0 +1,37 @@
+import asyncio
+
+from response_cache import ResponseCache
+
+
+def test_memory_is_bounded_by_bytes():
+    cache = ResponseCache(max_entries=100, max_memory_bytes=2000)
+    for i in range(20):
+        cache.put(f"k{i}", [[0, "x" * 300]])
+        assert cache.stats()["memory_bytes"] <= 2000
+    assert cache.get("k0") is None
+    assert cache.get("k19") == [[0, "x" * 300]]
+    cache.put("huge", [[0, "x" * 5000]])
+    assert cache.get("huge") is None
+
+
+def test_disk_is_bounded_and_indexed_at_startup(tmp_path):
+    cache = ResponseCache(cache_dir=tmp_path, max_disk_bytes=5000)
+    for i in range(20):
+        cache.put(f"k{i}", [[0, "x" * 300]])
+    files = list(tmp_path.glob("*.json"))
+    assert sum(path.stat().st_size for path in files) <= 5000
+    assert cache.stats()["disk_entries"] == len(files)
+
+    reopened = ResponseCache(cache_dir=tmp_path, max_disk_bytes=3000)
+    assert sum(path.stat().st_size for path in tmp_path.glob("*.json")) <= 3000
+    assert reopened.get("k19") == [[0, "x" * 300]]
+    assert reopened.get("k0") is None
+
+
+def test_async_access_reads_what_was_written(tmp_path):
+    async def roundtrip():
+        await ResponseCache(cache_dir=tmp_path).aput("a", [[0, "é"]])
+        cache = ResponseCache(cache_dir=tmp_path)
+        return await cache.aget("a"), await cache.aget("missing")
+
+    assert asyncio.run(roundtrip()) == ([[0, "é"]], None)
@@ -0,0 +1,91 @@
+import random
+
+from stream_parser import (
+    ANSWER_DELTA,
+    THINK_END,
+    THINK_START,
+    THINKING_DELTA,
+    THINKING_DONE,
+    ThinkStreamParser,
+)
+
+PIECES = [
+    "Hmm",
+    " so",
+    "<",
+    "/",
+    "think",
+    ">",
+    "<think>",
+    "</think>",
+    "<thi",
+    "nk>",
+    "é",
+]
+
+
+def parse_whole(text: str) -> tuple[str, str, int]:
+    """The thinking and answer text of a complete response, and its think blocks."""
+    parts = {True: [], False: []}
+    in_think = False
+    start = 0
+    blocks = 0
+    while True:
+        tag = THINK_END if in_think else THINK_START
+        found = text.find(tag, start)
+        if found == -1:
+            break
+        parts[in_think].append(text[start:found])
+        blocks += in_think
+        in_think = not in_think
+        start = found + len(tag)
+    parts[in_think].append(text[start:])
+    return "".join(parts[True]), "".join(parts[False]), blocks
+
+
+def split_chunks(text: str, rng: random.Random) -> list[str]:
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + rng.randint(1, 8)
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+def test_any_split_matches_whole_text_parse():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 40)))
+        parser = ThinkStreamParser()
+        events = []
+        for chunk in split_chunks(text, rng):
+            events += parser.feed(chunk)
+            assert len(parser.pending) < len(THINK_END)
+        events += parser.close()
+
+        thinking, answer, blocks = parse_whole(text)
+        assert parser.thinking == thinking
+        assert parser.answer == answer
+        assert "".join(e.text for e in events if e.type == THINKING_DELTA) == thinking
+        assert "".join(e.text for e in events if e.type == ANSWER_DELTA) == answer
+        assert sum(e.type == THINKING_DONE for e in events) == blocks
+
+
+def test_events_in_stream_order():
+    parser = ThinkStreamParser()
+    events = parser.feed("<thi") + parser.feed("nk>plan</th") + parser.feed("ink>yes")
+    events += parser.close()
+    assert [(e.type, e.text) for e in events] == [
+        (THINKING_DELTA, "plan"),
+        (THINKING_DONE, ""),
+        (ANSWER_DELTA, "yes"),
+    ]
+    assert parser.thinking_done
+
+
+def test_unfinished_tag_at_end_is_answer_text():
+    parser = ThinkStreamParser()
+    assert [e.text for e in parser.feed("a <thi")] == ["a "]
+    assert [e.text for e in parser.close()] == ["<thi"]
+    assert parser.answer == "a <thi"
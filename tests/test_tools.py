@@ -0,0 +1,38 @@
+import pytest
+
+from tools import ToolStep, calculator
+
+
+def tool_call_choice(arguments: str, name: str = "calculator") -> dict:
+    call = {"index": 0, "id": "c1", "function": {"name": name, "arguments": arguments}}
+    return {"index": 0, "delta": {"tool_calls": [call]}}
+
+
+@pytest.mark.parametrize("arguments", ["[]", '"x"', "3", "null"])
+def test_arguments_must_be_an_object(arguments):
+    step = ToolStep()
+    step.observe(tool_call_choice(arguments))
+    step.close()
+    step.wait()
+    call = step.calls[0]
+    assert call.status == "error"
+    assert "expected a JSON object" in call.result
+
+
+def test_call_runs_and_keeps_the_streamed_content():
+    step = ToolStep()
+    step.add_content("Let me compute. ")
+    step.observe(tool_call_choice('{"expression": "(3 + 4) * 2"}'))
+    step.close()
+    step.wait()
+    assistant, result = step.messages()
+    assert assistant["content"] == "Let me compute. "
+    assert result == {"role": "tool", "tool_call_id": "c1", "content": "14"}
+
+
+@pytest.mark.parametrize(
+    "expression", ["10**101", "((10**100)**100)**100", "(10**60) * (10**60)", "9" * 200]
+)
+def test_calculator_rejects_huge_numbers(expression):
+    with pytest.raises(ValueError):
+        calculator(expression)